@@ -1,12 +1,14 @@
 import streamlit as st
-from supabase import create_client
 from dotenv import load_dotenv
 import os
+import clients
+import data_access
+from scenario_model import Scene, join_moods, parse_moods
 
 # --- 初期設定 ---
 SUPABASE_URL = st.secrets["SUPABASE_URL"]
 SUPABASE_KEY = st.secrets["SUPABASE_KEY"]
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+supabase = clients.create_supabase(SUPABASE_URL, SUPABASE_KEY)
 
 password = st.text_input("パスワードを入力", type="password")
 if password != st.secrets["APP_PASSWORD"]:
@@ -15,20 +17,23 @@ if password != st.secrets["APP_PASSWORD"]:
 # --- モード選択 ---
 mode = st.radio("モード選択", ["新規作成", "修正モード"], horizontal=True)
 
-# --- キャラ情報取得 ---
-char_data = supabase.table("characters").select("id, name").execute().data
-char_dict = {c["name"]: c["id"] for c in char_data}
-
-# --- 章タイトル一覧取得 ---
-chapter_titles_data = supabase.table("scenario_plots").select("chapter_title, chapter_index, id, scene_index, plot_text, location, mood, related_characters, related_context_ids").execute().data
-chapter_title_map = {c["chapter_title"]: c["chapter_index"] for c in chapter_titles_data if c["chapter_title"]}
-chapter_title_list = list(chapter_title_map.keys())
+# --- キャラ情報・シーン一覧取得 ---
+char_dict = data_access.load_character_index(supabase).char_dict
+scenario = data_access.load_scenario(supabase)
+chapter_title_map = scenario.chapter_title_map
+chapter_title_list = scenario.chapter_titles
 
 selected_record = None
 if mode == "修正モード":
-    record_options = {f"{r['chapter_title']} - {r['scene_index']}": r for r in chapter_titles_data}
+    record_options = scenario.record_options()
     selected_label = st.selectbox("修正対象を選択", options=[""] + list(record_options.keys()))
-    selected_record = record_options.get(selected_label)
+    if selected_label:
+        # 編集開始時点のレコードを固定しておき、保存時の version 比較に使う（load_scene は他の保存で読み直されるため）
+        loaded = data_access.load_scene(supabase, record_options[selected_label])
+        edit_base = st.session_state.get("edit_base")
+        if loaded and (not edit_base or edit_base["id"] != loaded["id"]):
+            st.session_state["edit_base"] = loaded
+        selected_record = st.session_state.get("edit_base") if loaded else None
 
 # --- UI表示 ---
 st.title("\U0001F4D8 シナリオプロット登録")
@@ -46,20 +51,19 @@ else:
     chapter_index = chapter_title_map.get(chapter_title, 0)
 
 # --- シーン番号入力（自動＋修正可） ---
-scene_data = supabase.table("scenario_plots").select("scene_index").eq("chapter_index", chapter_index).execute().data
-scene_index_default = selected_record["scene_index"] if selected_record else max([s["scene_index"] for s in scene_data], default=-1) + 1
+scene_index_default = selected_record["scene_index"] if selected_record else scenario.next_scene_index(chapter_index)
 scene_index = st.number_input("シーン番号", min_value=0, step=1, value=scene_index_default)
 
 location = st.text_input("場所", value=selected_record["location"] if selected_record else "", key="location")
 
 # --- 雰囲気（複数選択＋自由記述） ---
 mood_options = ["切ない", "悲しい", "怒り", "不安", "希望", "緊張感", "熱い", "ほのぼの", "その他"]
-stored_moods = selected_record["mood"].split("/") if selected_record else []
+stored_moods = parse_moods(selected_record["mood"]) if selected_record else ()
 default_moods = [m for m in stored_moods if m in mood_options]
 unknown_moods = [m for m in stored_moods if m not in mood_options]
 selected_moods = st.multiselect("雰囲気（複数選択可）", options=mood_options, default=default_moods, key="selected_moods")
-custom_mood = st.text_input("その他の雰囲気（自由記述）", value="/".join(unknown_moods), key="custom_mood")
-mood = "/".join(selected_moods + ([custom_mood] if custom_mood else []))
+custom_mood = st.text_input("その他の雰囲気（自由記述）", value=join_moods(unknown_moods), key="custom_mood")
+moods = selected_moods + ([custom_mood] if custom_mood else [])
 
 # --- キャラ選択UI（複数選択＋UUID） ---
 st.markdown("**登場キャラ**（名前をクリックでUUID追加）")
@@ -76,25 +80,28 @@ context_ids = [s.strip() for s in related_context_ids.split(",") if s.strip()]
 
 # --- 登録または修正 ---
 if st.button("保存"):
-    record = {
-        "chapter_index": chapter_index,
-        "chapter_title": chapter_title,
-        "scene_index": scene_index,
-        "plot_text": plot_text,
-        "location": location,
-        "mood": mood,
-        "related_characters": related_characters,
-        "related_context_ids": context_ids,
-        "needs_indexing": True
-    }
+    record = Scene(
+        chapter_index=chapter_index,
+        chapter_title=chapter_title,
+        scene_index=scene_index,
+        plot_text=plot_text,
+        location=location,
+        moods=moods,
+        related_characters=related_characters,
+        related_context_ids=context_ids
+    ).to_row()
     try:
         if mode == "修正モード" and selected_record:
-            supabase.table("scenario_plots").update(record).eq("id", selected_record["id"]).execute()
+            st.session_state["edit_base"] = data_access.update_scene(supabase, selected_record["id"], record, selected_record.get("version", 1))
             st.success("修正が完了しました！")
         else:
-            supabase.table("scenario_plots").insert(record).execute()
+            data_access.insert_scene(supabase, record)
             st.success("登録成功しました！")
         st.json(record)
+    except data_access.StaleWriteError as e:
+        st.error("保存できませんでした。このシーンは編集中に他のユーザーが更新しています。")
+        # 最新版を基準に切り替える。入力中の内容は残るので、確認してもう一度保存すると上書きする
+        st.session_state["edit_base"] = e.current
     except Exception as e:
         st.error(f"保存エラー: {e}")
 
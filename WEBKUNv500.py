@@ -1,10 +1,18 @@
 import streamlit as st
-from supabase import create_client
+import metrics
+
+# 以降の import も初回描画までの時間に含めて計測する
+metrics.start_rerun()
+
 from dotenv import load_dotenv
 import os
-import openai
-from openai import OpenAI
-from pinecone import Pinecone
+import io
+import clients
+import data_access
+import indexer
+import scene_io
+import vector_target
+from scenario_model import Scene, join_moods, parse_moods
 
 # --- 初期設定 ---
 load_dotenv()
@@ -13,60 +21,188 @@ SUPABASE_KEY = st.secrets["SUPABASE_KEY"]
 OPENAI_API_KEY = st.secrets["OPENAI_API_KEY"]
 PINECONE_API_KEY = st.secrets["PINECONE_API_KEY"]
 PINECONE_INDEX_NAME = st.secrets["PINECONE_INDEX_NAME"]
+FIRST_PAINT_TARGET_SECONDS = 0.3
+
+
+# クライアントは初めて使うときに作り、全セッションで共有する
+@st.cache_resource
+def get_supabase():
+    return clients.create_supabase(SUPABASE_URL, SUPABASE_KEY)
+
+
+# 読み書き先（インデックス・名前空間・モデル）は app_config の現在の設定に従う
+@st.cache_resource
+def get_index(index_name, namespace):
+    return clients.create_target_index(PINECONE_API_KEY, index_name, namespace)
+
+
+@st.cache_resource
+def get_embedder(model):
+    return clients.create_embedder(OPENAI_API_KEY, model)
+
+
+# --- キャッシュ状況と計測パネル（管理者向け） ---
+# どのモードでも st.stop() の前に呼び、サイドバーの表示と実行ログを残す
+def finish_rerun(mode):
+    cache_info = data_access.cache_stats()
+    st.sidebar.caption(f"キャッシュ: ヒット {cache_info['hits']} / ミス {cache_info['misses']}")
 
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-client = OpenAI(api_key=OPENAI_API_KEY)
-pc = Pinecone(api_key=PINECONE_API_KEY)
-index = pc.Index(PINECONE_INDEX_NAME)
+    if st.sidebar.checkbox("計測パネルを表示"):
+        st.sidebar.markdown(f"**今回の実行** {metrics.rerun_elapsed() * 1000:.0f}ms")
+        first_paint = metrics.registry.summary()["timers"].get("startup.first_paint")
+        if first_paint:
+            st.sidebar.markdown(f"**初回描画** p50 {first_paint['p50'] * 1000:.0f}ms / p99 {first_paint['p99'] * 1000:.0f}ms（目標 {FIRST_PAINT_TARGET_SECONDS * 1000:.0f}ms）")
+        st.sidebar.dataframe(
+            [{"処理": name, "ms": round(seconds * 1000, 1)} for name, seconds in metrics.rerun_timings()],
+            hide_index=True
+        )
+        st.sidebar.markdown("**累計（プロセス全体）**")
+        summary = metrics.registry.summary()
+        st.sidebar.dataframe(
+            [
+                {"処理": name, "回数": t["count"], "p50 ms": round(t["p50"] * 1000, 1), "p99 ms": round(t["p99"] * 1000, 1)}
+                for name, t in summary["timers"].items()
+            ],
+            hide_index=True
+        )
+        st.sidebar.json(summary["counters"])
+        st.sidebar.download_button("Prometheus形式でダウンロード", data=metrics.to_prometheus(), file_name="webkun_metrics.prom")
+    metrics.log_rerun(mode=mode)
 
-EMBEDDING_MODEL = "text-embedding-3-small"
 
 # --- 認証 ---
 password = st.text_input("パスワードを入力", type="password")
+metrics.mark("startup.first_paint")
 if password != st.secrets["APP_PASSWORD"]:
     st.stop()
 
-# --- データ取得 ---
-areas = supabase.table("location_areas").select("id, name, parent_id, level").execute().data
-locations = supabase.table("locations").select("id, name, area_id").execute().data
-characters = supabase.table("characters").select("id, name").execute().data
-char_dict = {c["name"]: c["id"] for c in characters}
-
-# --- ツリー構造用辞書 ---
-area_dict = {a["id"]: a for a in areas}
-def get_full_area_name(area_id):
-    names = []
-    while area_id:
-        area = area_dict.get(area_id)
-        if area:
-            names.insert(0, area["name"])
-            area_id = area["parent_id"]
-        else:
-            break
-    return names
+supabase = get_supabase()
 
-location_display_map = {
-    f"{'、'.join(get_full_area_name(l['area_id']))}、{l['name']}": l["id"] for l in locations
-}
+# --- データ取得（エリア階層・キャラ・シーン一覧） ---
+page_data = data_access.load_page(supabase)
+area_tree = page_data["area_tree"]
+char_dict = page_data["char_dict"]
+scenario = page_data["scenario"]
+chapter_title_map = page_data["chapter_title_map"]
 
 # --- モード選択 ---
-mode = st.radio("モード選択", ["新規作成", "修正モード"], horizontal=True)
+mode = st.radio("モード選択", ["新規作成", "修正モード", "類似シーン検索", "分析"], horizontal=True)
+
+# --- 類似シーン検索 ---
+if mode == "類似シーン検索":
+    st.title("\U0001F50D 類似シーン検索")
+    search_query = st.text_area("検索文（空欄なら入力中のプロット本文）", key="search_query")
+    filter_chapters = st.multiselect("章で絞り込み", options=list(chapter_title_map.keys()))
+    filter_chars = st.multiselect("登場キャラで絞り込み", options=list(char_dict.keys()))
+    filter_types = st.multiselect("チャンク種別", options=["plot_text"])
+    top_k = st.slider("件数", min_value=1, max_value=50, value=10)
+    backend = st.radio("検索先", ["ローカル", "Pinecone"], horizontal=True)
+    text = search_query or st.session_state.get("draft_plot_text", "")
+    if st.button("検索") and text:
+        try:
+            from vector_search import PineconeSearchBackend
+
+            target = data_access.load_active_target(supabase, PINECONE_INDEX_NAME)
+            embedder, _ = get_embedder(target["model"])
+            searcher = data_access.load_vector_index(supabase, embedder) if backend == "ローカル" else PineconeSearchBackend(get_index(target["index"], target["namespace"]))
+            # ローカルの索引は初回だけ別スレッドで作っている最中のことがある
+            results = None
+            if searcher is None:
+                st.info("ローカル検索の索引を作成中です。しばらくしてからもう一度検索してください（Pinecone検索はすぐに使えます）。")
+            else:
+                with metrics.timer("search.embed_query"):
+                    query_vector = embedder.embed([text])[0]
+                with metrics.timer(f"search.query.{backend}"):
+                    results = searcher.query(
+                        query_vector,
+                        top_k=top_k,
+                        chapter_indexes=[chapter_title_map[c] for c in filter_chapters],
+                        characters=[char_dict[c] for c in filter_chars],
+                        chunk_types=filter_types
+                    )
+            if results == []:
+                st.info("該当するシーンはありません。")
+            for r in results or []:
+                meta = r["metadata"]
+                st.markdown(f"**{meta['chapter_title']} - {meta['scene_index']}**（{r['id']} / 類似度 {r['score']:.3f}）")
+                st.text(meta["chunk"])
+        except Exception as e:
+            st.error(f"検索エラー: {e}")
+    finish_rerun(mode)
+    st.stop()
+
+# --- 分析 ---
+ANALYTICS_TABLE_LIMIT = 200
 
-# --- 章タイトル一覧取得 ---
-chapter_titles_data = supabase.table("scenario_plots").select("chapter_title, chapter_index, id, scene_index, plot_text, location, mood, related_characters, related_context_ids").execute().data
-chapter_title_map = {c["chapter_title"]: c["chapter_index"] for c in chapter_titles_data if c["chapter_title"]}
-chapter_title_list = list(chapter_title_map.keys())
+if mode == "分析":
+    st.title("\U0001F4CA シナリオ分析")
+    analysis = data_access.load_analytics(supabase)
+    st.caption(f"シーン {len(scenario)}件 / 章 {len(analysis.chapters)} / キャラ {analysis.known_characters}人")
+
+    st.subheader("キャラ別の登場シーン数（章ごと）")
+    st.dataframe(analysis.character_chapter_table(ANALYTICS_TABLE_LIMIT), hide_index=True)
+    focus_char = st.selectbox("登場シーンを一覧するキャラ", options=[""] + list(char_dict.keys()))
+    if focus_char:
+        st.dataframe(
+            [{"シーン": s.label, "場所": s.location, "雰囲気": s.mood} for s in analysis.scenes_for_character(char_dict[focus_char])],
+            hide_index=True
+        )
+
+    st.subheader("雰囲気の分布（章ごと）")
+    st.dataframe(analysis.mood_chapter_table(share=st.checkbox("章ごとの割合で表示")), hide_index=True)
+
+    st.subheader("場所の使用回数")
+    st.dataframe(analysis.area_table(), hide_index=True)
+    st.dataframe(analysis.location_table(ANALYTICS_TABLE_LIMIT), hide_index=True)
+
+    st.subheader("参照チェック")
+    dangling = analysis.dangling_references()
+    if dangling:
+        st.warning(f"存在しないシーンを指している関連IDが{len(dangling)}件あります。")
+        st.dataframe(dangling, hide_index=True)
+    else:
+        st.success("関連IDはすべて既存のシーンを指しています。")
+    unknown_chars = analysis.unknown_characters()
+    if unknown_chars:
+        st.warning(f"登録されていないキャラIDが{len(unknown_chars)}件あります。")
+        st.dataframe(unknown_chars, hide_index=True)
+    finish_rerun(mode)
+    st.stop()
+
+# --- 章タイトル一覧 ---
+chapter_title_list = scenario.chapter_titles
+
+SCENE_PICKER_PAGE_SIZE = 200
 
 selected_record = None
 if mode == "修正モード":
-    record_options = {f"{r['chapter_title']} - {r['scene_index']}": r for r in chapter_titles_data}
+    picker_chapter = st.selectbox("章で絞り込み", options=["すべて"] + chapter_title_list)
+    picker_chapter_index = chapter_title_map.get(picker_chapter)
+    search_text = st.text_input("本文で検索", key="scene_search")
+    if search_text:
+        candidates = data_access.search_scenes(supabase, search_text, picker_chapter_index)
+    else:
+        candidates = scenario.scenes if picker_chapter_index is None else scenario.by_chapter.get(picker_chapter_index, [])
+        page_count = max(1, -(-len(candidates) // SCENE_PICKER_PAGE_SIZE))
+        if page_count > 1:
+            page = st.number_input(f"ページ（全{page_count}）", min_value=1, max_value=page_count, step=1, value=1)
+            candidates = candidates[(page - 1) * SCENE_PICKER_PAGE_SIZE:page * SCENE_PICKER_PAGE_SIZE]
+    record_options = {s.label: s.id for s in candidates}
     selected_label = st.selectbox("修正対象を選択", options=[""] + list(record_options.keys()))
-    selected_record = record_options.get(selected_label)
+    if selected_label:
+        # 編集開始時点のレコードを固定しておき、保存時の version 比較に使う
+        loaded = data_access.load_scene(supabase, record_options[selected_label])
+        edit_base = st.session_state.get("edit_base")
+        if loaded and (not edit_base or edit_base["id"] != loaded["id"]):
+            st.session_state["edit_base"] = loaded
+        selected_record = st.session_state.get("edit_base") if loaded else None
 
 # --- UI表示 ---
 st.title("\U0001F4D8 シナリオプロット登録")
 
 plot_text = st.text_area("プロット本文", value=selected_record["plot_text"] if selected_record else "", key="plot_text")
+# 検索モードでは本文の入力欄を描画しないので、ウィジェットの状態は消える。検索に使えるよう別のキーに控えておく
+st.session_state["draft_plot_text"] = plot_text
 
 chapter_title_options = chapter_title_list + ["新規追加"]
 chapter_title_default = selected_record["chapter_title"] if selected_record else chapter_title_options[0]
@@ -77,23 +213,52 @@ if chapter_title == "新規追加":
 else:
     chapter_index = chapter_title_map.get(chapter_title, 0)
 
-scene_data = supabase.table("scenario_plots").select("scene_index").eq("chapter_index", chapter_index).execute().data
-scene_index_default = selected_record["scene_index"] if selected_record else max([s["scene_index"] for s in scene_data], default=-1) + 1
-scene_index = st.number_input("シーン番号", min_value=0, step=1, value=scene_index_default)
+scene_index_default = selected_record["scene_index"] if selected_record else scenario.next_scene_index(chapter_index)
+auto_scene_index = False
+if not selected_record:
+    auto_scene_index = st.checkbox("シーン番号を保存時に自動採番", value=True, key="auto_scene_index")
+scene_index = st.number_input("シーン番号", min_value=0, step=1, value=scene_index_default, disabled=auto_scene_index)
 
-# --- 場所選択 ---
-location_names = list(location_display_map.keys()) + ["自由入力"]
+# --- 場所選択（エリア階層で絞り込み） ---
+LOCATION_PICKER_LIMIT = 500
+
+browse_area_id = None
+level_options = area_tree.roots
+depth = 0
+while level_options:
+    choice = st.selectbox(
+        "エリア" if depth == 0 else "　" * depth + "└ サブエリア",
+        options=[None] + level_options,
+        format_func=lambda a: "すべて" if a is None else area_tree.name(a),
+        key=f"area_level_{depth}"
+    )
+    if choice is None:
+        break
+    browse_area_id = choice
+    level_options = area_tree.children.get(choice, [])
+    depth += 1
+
+location_filter = st.text_input("場所名で絞り込み", key="location_filter")
+with metrics.timer("build.location_names"):
+    location_names = [
+        area_tree.location_label(l) for l in area_tree.locations_in(browse_area_id)
+        if not location_filter or location_filter in l["name"]
+    ]
+if len(location_names) > LOCATION_PICKER_LIMIT:
+    st.caption(f"{len(location_names)}件中{LOCATION_PICKER_LIMIT}件を表示中。エリアか場所名で絞り込んでください。")
+    location_names = location_names[:LOCATION_PICKER_LIMIT]
+location_names += ["自由入力"]
 location_choice = st.selectbox("場所選択", options=location_names)
 location = st.text_input("場所（自由入力可）", value="" if location_choice == "自由入力" else location_choice, disabled=location_choice != "自由入力")
 
 # --- 雰囲気選択 ---
 mood_options = ["切ない", "悲しい", "怒り", "不安", "希望", "緊張感", "熱い", "ほのぼの", "その他"]
-stored_moods = selected_record["mood"].split("/") if selected_record else []
+stored_moods = parse_moods(selected_record["mood"]) if selected_record else ()
 default_moods = [m for m in stored_moods if m in mood_options]
 unknown_moods = [m for m in stored_moods if m not in mood_options]
 selected_moods = st.multiselect("雰囲気（複数選択可）", options=mood_options, default=default_moods, key="selected_moods")
-custom_mood = st.text_input("その他の雰囲気（自由記述）", value="/".join(unknown_moods), key="custom_mood")
-mood = "/".join(selected_moods + ([custom_mood] if custom_mood else []))
+custom_mood = st.text_input("その他の雰囲気（自由記述）", value=join_moods(unknown_moods), key="custom_mood")
+moods = selected_moods + ([custom_mood] if custom_mood else [])
 
 st.markdown("**登場キャラ**（名前をクリックでUUID追加）")
 selected_chars = st.multiselect("登場キャラ選択", options=list(char_dict.keys()), key="selected_chars")
@@ -106,25 +271,32 @@ related_context_ids = st.text_input("関連ID(カンマ区切り)", value=",".jo
 context_ids = [s.strip() for s in related_context_ids.split(",") if s.strip()]
 
 if st.button("保存"):
-    record = {
-        "chapter_index": chapter_index,
-        "chapter_title": chapter_title,
-        "scene_index": scene_index,
-        "plot_text": plot_text,
-        "location": location,
-        "mood": mood,
-        "related_characters": related_characters,
-        "related_context_ids": context_ids,
-        "needs_indexing": True
-    }
+    record = Scene(
+        chapter_index=chapter_index,
+        chapter_title=chapter_title,
+        scene_index=scene_index,
+        plot_text=plot_text,
+        location=location,
+        moods=moods,
+        related_characters=related_characters,
+        related_context_ids=context_ids
+    ).to_row()
     try:
         if mode == "修正モード" and selected_record:
-            supabase.table("scenario_plots").update(record).eq("id", selected_record["id"]).execute()
+            saved = data_access.update_scene(supabase, selected_record["id"], record, selected_record.get("version", 1))
+            st.session_state["edit_base"] = saved
             st.success("修正が完了しました！")
         else:
-            supabase.table("scenario_plots").insert(record).execute()
-            st.success("登録成功しました！")
-        st.json(record)
+            saved = data_access.insert_scene(supabase, record, auto_scene_index)
+            st.success(f"登録成功しました！（シーン番号 {saved['scene_index']}）")
+        st.json(saved)
+    except data_access.StaleWriteError as e:
+        st.error("保存できませんでした。このシーンは編集中に他のユーザーが更新しています。")
+        if e.current:
+            st.code(data_access.record_diff(e.current, record), language="diff")
+            # 最新版を基準に切り替える。入力中の内容はそのまま残るので、差分を確認して再度保存する
+            st.session_state["edit_base"] = e.current
+            st.info("最新版を基準にしました。内容を確認してもう一度保存すると上書きします。")
     except Exception as e:
         st.error(f"保存エラー: {e}")
 
@@ -133,59 +305,55 @@ if st.button("リセット"):
         if key in st.session_state:
             st.session_state[key] = [] if isinstance(st.session_state[key], list) else ""
 
-# --- Pinecone同期機能 ---
+# --- 一括インポート/エクスポート ---
 st.markdown("---")
-st.header("\U0001F9E0 Pinecone同期操作")
+st.header("\U0001F4E6 一括インポート/エクスポート")
 
-def build_chunk_text(plot_text, location, mood):
-    return f"{plot_text}\n場所: {location}\n雰囲気: {mood}"
+uploaded = st.file_uploader("シーンファイル（JSONL/CSV）", type=["jsonl", "csv"])
+index_on_import = st.checkbox("取り込みと同時にPineconeへ反映する")
+if uploaded and st.button("インポート"):
+    try:
+        progress = st.empty()
+        # 書き込み先はキャッシュを通さずに読む（切り替え直後に旧インデックスへ書き込まないように）
+        target = vector_target.load_active_target(supabase, PINECONE_INDEX_NAME)
+        embedder, embedding_cache = get_embedder(target["model"]) if index_on_import else (None, None)
+        stats = scene_io.import_scenes(
+            supabase, io.TextIOWrapper(uploaded, encoding="utf-8-sig", newline=""), scene_io.detect_format(uploaded.name), char_dict,
+            index=get_index(target["index"], target["namespace"]) if index_on_import else None, embedder=embedder,
+            cache=embedding_cache.for_target(target) if index_on_import else None,
+            on_batch=lambda s: progress.text(f"{s['imported']}件取り込み済み"),
+            check_target=vector_target.target_guard(supabase, target, PINECONE_INDEX_NAME)
+        )
+        data_access.invalidate("scenario_plots")
+        st.success(f"{stats['imported']}件取り込みました（Pinecone反映 {stats['indexed']}件）")
+        if stats["target_changed"]:
+            st.info("取り込み中に書き込み先が切り替わりました。残りの行は次回の同期で新しい書き込み先に反映されます。")
+        for line_no, message in stats["errors"]:
+            st.warning(f"{line_no}行目: {message}")
+    except Exception as e:
+        st.error(f"インポートエラー: {e}")
 
-def build_context_id(chapter_index, scene_index):
-    return f"plot-ch{chapter_index}-{scene_index}"
+export_format = st.radio("エクスポート形式", ["jsonl", "csv"], horizontal=True)
+if st.button("エクスポート用ファイルを作成"):
+    buffer = io.StringIO()
+    count = scene_io.export_scenes(supabase, buffer, export_format)
+    st.download_button(f"ダウンロード（{count}件）", data=buffer.getvalue().encode("utf-8"), file_name=f"scenario_plots.{export_format}")
 
-def embed_text(text):
-    response = client.embeddings.create(
-        input=[text],
-        model=EMBEDDING_MODEL
-    )
-    return response.data[0].embedding
-
-def save_to_pinecone(records):
-    pinecone_vectors = []
-    for record in records:
-        chunk = build_chunk_text(record["plot_text"], record["location"], record["mood"])
-        context_id = build_context_id(record["chapter_index"], record["scene_index"])
-        vector = embed_text(chunk)
-
-        metadata = {
-            "context_id": context_id,
-            "chapter_index": record["chapter_index"],
-            "scene_index": record["scene_index"],
-            "chunk": chunk,
-            "chunk_type": "plot_text",
-            "chapter_title": record["chapter_title"],
-            "related_characters": record["related_characters"],
-            "related_context_ids": record["related_context_ids"]
-        }
-
-        pinecone_vectors.append({
-            "id": context_id,
-            "values": vector,
-            "metadata": metadata
-        })
-
-    index.upsert(vectors=pinecone_vectors)
-    record_ids = [r["id"] for r in records]
-    for rid in record_ids:
-        supabase.table("scenario_plots").update({"needs_indexing": False}).eq("id", rid).execute()
+# --- Pinecone同期機能 ---
+st.markdown("---")
+st.header("\U0001F9E0 Pinecone同期操作")
+st.caption(f"読み書き先: {vector_target.target_label(data_access.load_active_target(supabase, PINECONE_INDEX_NAME))}")
 
+# 同期は indexer.py のワーカープロセスで行い、ここでは起動するだけ
+if indexer.is_running():
+    st.info("同期ワーカーが実行中です。")
 if st.button("Pineconeに同期"):
-    try:
-        data_to_index = supabase.table("scenario_plots").select("*").eq("needs_indexing", True).execute().data
-        if not data_to_index:
-            st.info("同期対象はありません。")
-        else:
-            save_to_pinecone(data_to_index)
-            st.success("Pineconeへの同期が完了しました！")
-    except Exception as e:
-        st.error(f"同期中にエラーが発生しました: {e}")
+    settings = {k: st.secrets[k] for k in indexer.SETTING_KEYS}
+    if indexer.trigger_worker(settings):
+        st.success("同期ワーカーを起動しました。完了までブラウザを閉じても問題ありません。")
+    else:
+        st.info("同期ワーカーは既に実行中です。")
+with st.expander("ワーカーログ"):
+    st.text(indexer.read_log_tail())
+
+finish_rerun(mode)
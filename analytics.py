@@ -0,0 +1,155 @@
+import numpy as np
+
+from pinecone_sync import build_context_id
+
+UNSET_LOCATION = "（未設定）"
+FREE_LOCATION_AREA = "（自由入力）"
+
+
+# --- 文字列 → 連番コード ---
+# 同じ値には同じコードを振り、コード順の値リストも返す
+class _Codes:
+    def __init__(self, values=()):
+        self.values = []
+        self.codes = {}
+        for value in values:
+            self.code(value)
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def __len__(self):
+        return len(self.values)
+
+
+# シーンごとのリスト列を (シーン行, 値コード) の2本の配列に展開する
+def _explode(scenes, field, codes):
+    rows = []
+    values = []
+    for row, scene in enumerate(scenes):
+        items = getattr(scene, field)
+        rows += [row] * len(items)
+        values += [codes.code(v) for v in items]
+    return np.asarray(rows, dtype=np.int64), np.asarray(values, dtype=np.int64)
+
+
+# 行コード×列コードの出現回数を bincount でまとめて数える
+def _crosstab(row_codes, col_codes, shape):
+    counts = np.bincount(row_codes * shape[1] + col_codes, minlength=shape[0] * shape[1])
+    return counts.reshape(shape)
+
+
+# --- シナリオ全体の集計（列指向） ---
+# Scenario・CharacterIndex・AreaTree から1回だけ配列を作り、集計はすべて NumPy で行う
+class ScenarioAnalytics:
+    def __init__(self, scenario, characters, area_tree):
+        self.scenario = scenario
+        scenes = scenario.scenes
+
+        # 章
+        self.chapters = sorted(scenario.by_chapter)
+        chapter_codes = {c: i for i, c in enumerate(self.chapters)}
+        self.chapter_labels = [f"{c}: {scenario.by_chapter[c][0].chapter_title}" for c in self.chapters]
+        self.scene_chapter = np.fromiter((chapter_codes[s.chapter_index] for s in scenes), dtype=np.int64, count=len(scenes))
+        chapter_count = len(self.chapters)
+
+        # 登場キャラ（未登録のIDも列に含め、known_characters より後ろのコードになる）
+        self.character_codes = _Codes(characters.by_id)
+        self.known_characters = len(self.character_codes)
+        char_rows, char_codes = _explode(scenes, "related_characters", self.character_codes)
+        self.character_names = characters.names(self.character_codes.values)
+        self.character_matrix = _crosstab(char_codes, self.scene_chapter[char_rows], (len(self.character_codes), chapter_count))
+        self.character_totals = self.character_matrix.sum(axis=1)
+        self.unknown_character_rows = char_rows[char_codes >= self.known_characters]
+        self.unknown_character_codes = char_codes[char_codes >= self.known_characters]
+
+        # 雰囲気
+        self.mood_codes = _Codes()
+        mood_rows, mood_codes = _explode(scenes, "moods", self.mood_codes)
+        self.mood_matrix = _crosstab(mood_codes, self.scene_chapter[mood_rows], (len(self.mood_codes), chapter_count))
+        self.mood_totals = self.mood_matrix.sum(axis=1)
+
+        # 場所（最上位エリアごとにもまとめる）
+        self.location_codes = _Codes()
+        scene_location = np.fromiter((self.location_codes.code(s.location or UNSET_LOCATION) for s in scenes), dtype=np.int64, count=len(scenes))
+        self.location_totals = np.bincount(scene_location, minlength=len(self.location_codes))
+        # 場所は「エリア、…、場所名」の表示名で保存されるが、旧バージョンの画面で入力した場所名だけの値も拾う
+        area_by_label = {area_tree.location_label(l): l["area_id"] for l in area_tree.locations}
+        area_by_name = {l["name"]: l["area_id"] for l in area_tree.locations}
+        self.area_codes = _Codes()
+        location_area = np.asarray([
+            self.area_codes.code(self._root_area(area_tree, area_by_label.get(label) or area_by_name.get(label), label))
+            for label in self.location_codes.values
+        ], dtype=np.int64)
+        self.area_totals = np.bincount(location_area[scene_location], minlength=len(self.area_codes))
+
+        # 関連ID（シーンのコンテキストIDかシーンIDのどちらかに一致すれば有効）
+        self.reference_codes = _Codes()
+        self.reference_rows, reference_codes = _explode(scenes, "related_context_ids", self.reference_codes)
+        existing = {build_context_id(s.chapter_index, s.scene_index) for s in scenes} | {str(s.id) for s in scenes}
+        valid = np.fromiter((r in existing for r in self.reference_codes.values), dtype=bool, count=len(self.reference_codes))
+        dangling = ~valid[reference_codes]
+        self.dangling_rows = self.reference_rows[dangling]
+        self.dangling_codes = reference_codes[dangling]
+
+    @staticmethod
+    def _root_area(area_tree, area_id, label):
+        if label == UNSET_LOCATION:
+            return UNSET_LOCATION
+        path = area_tree.path(area_id)
+        return path[0] if path else FREE_LOCATION_AREA
+
+    # --- 画面用の取り出し ---
+    def top_characters(self, limit=None):
+        totals = self.character_totals
+        order = np.argsort(-totals, kind="stable")
+        order = order[totals[order] > 0]
+        return order[:limit] if limit else order
+
+    def character_chapter_table(self, limit=None):
+        rows = self.top_characters(limit)
+        table = {"キャラ": [self.character_names[i] for i in rows], "合計": self.character_totals[rows]}
+        for column, label in enumerate(self.chapter_labels):
+            table[label] = self.character_matrix[rows, column]
+        return table
+
+    # share=True なら章ごとの割合（各章で雰囲気が付いた回数の合計を1とする）
+    def mood_chapter_table(self, share=False):
+        rows = np.argsort(-self.mood_totals, kind="stable")
+        matrix = self.mood_matrix
+        if share:
+            totals = matrix.sum(axis=0)
+            matrix = matrix / np.where(totals == 0, 1, totals)
+        table = {"雰囲気": [self.mood_codes.values[i] for i in rows], "合計": self.mood_totals[rows]}
+        for column, label in enumerate(self.chapter_labels):
+            table[label] = matrix[rows, column]
+        return table
+
+    def location_table(self, limit=None):
+        rows = np.argsort(-self.location_totals, kind="stable")[:limit]
+        return {"場所": [self.location_codes.values[i] for i in rows], "シーン数": self.location_totals[rows]}
+
+    def area_table(self):
+        rows = np.argsort(-self.area_totals, kind="stable")
+        return {"エリア": [self.area_codes.values[i] for i in rows], "シーン数": self.area_totals[rows]}
+
+    def dangling_references(self):
+        scenes = self.scenario.scenes
+        return [
+            {"シーン": scenes[row].label, "関連ID": self.reference_codes.values[code]}
+            for row, code in zip(self.dangling_rows.tolist(), self.dangling_codes.tolist())
+        ]
+
+    def unknown_characters(self):
+        scenes = self.scenario.scenes
+        return [
+            {"シーン": scenes[row].label, "キャラID": self.character_codes.values[code]}
+            for row, code in zip(self.unknown_character_rows.tolist(), self.unknown_character_codes.tolist())
+        ]
+
+    def scenes_for_character(self, character_id):
+        return self.scenario.by_character.get(character_id, [])
@@ -0,0 +1,73 @@
+# --- エリア階層インデックス ---
+# データのバージョンごとに1回だけ作り、祖先パス・子リスト・サブツリーをまとめて引けるようにする
+class AreaTree:
+    def __init__(self, areas, locations=()):
+        self.areas = {a["id"]: a for a in areas}
+        self.children = {}
+        self.roots = []
+        for area in areas:
+            parent_id = area.get("parent_id")
+            if parent_id and parent_id in self.areas and parent_id != area["id"]:
+                self.children.setdefault(parent_id, []).append(area["id"])
+            else:
+                # 親が存在しないエリア（孤児）はルートとして扱う
+                self.roots.append(area["id"])
+        self._paths = {}
+        for area_id in self.areas:
+            self.path(area_id)
+        # 循環しているエリアはルートからたどれないので、ルートとして扱う
+        reachable = set()
+        for root in self.roots:
+            reachable.update(self.subtree(root))
+        for area_id in self.areas:
+            if area_id not in reachable:
+                self.roots.append(area_id)
+                reachable.update(self.subtree(area_id))
+
+        self.locations = list(locations)
+        self.locations_by_area = {}
+        for location in self.locations:
+            self.locations_by_area.setdefault(location["area_id"], []).append(location)
+
+    def path(self, area_id):
+        if area_id in self._paths:
+            return self._paths[area_id]
+        if area_id not in self.areas:
+            return ()
+        # 既知のパスか未登録の親に当たるまで親をたどる（循環は同じIDを2度見たところで打ち切る）
+        chain = []
+        seen = set()
+        current = area_id
+        while current in self.areas and current not in self._paths and current not in seen:
+            seen.add(current)
+            chain.append(current)
+            current = self.areas[current].get("parent_id")
+        prefix = self._paths.get(current, ())
+        for node in reversed(chain):
+            prefix = prefix + (self.areas[node]["name"],)
+            self._paths[node] = prefix
+        return self._paths[area_id]
+
+    def subtree(self, area_id):
+        result = []
+        seen = set()
+        stack = [area_id]
+        while stack:
+            current = stack.pop()
+            if current in seen:
+                continue
+            seen.add(current)
+            result.append(current)
+            stack.extend(self.children.get(current, ()))
+        return result
+
+    def location_label(self, location):
+        return f"{'、'.join(self.path(location['area_id']))}、{location['name']}"
+
+    def locations_in(self, area_id=None):
+        if area_id is None:
+            return self.locations
+        return [l for a in self.subtree(area_id) for l in self.locations_by_area.get(a, ())]
+
+    def name(self, area_id):
+        return self.areas[area_id]["name"]
@@ -0,0 +1,178 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import data_access
+import metrics
+from embedding import BatchEmbedder
+from embedding_cache import CachedEmbedder, EmbeddingCache
+from fakes import FakeEmbeddingsClient, FakeIndex, FakeSupabase
+from pinecone_sync import sync_dirty_records
+
+MOODS = ["切ない", "悲しい", "怒り", "不安", "希望", "緊張感", "熱い", "ほのぼの"]
+
+
+# --- 合成シナリオ ---
+def generate_scenario(chapters=20, scenes_per_chapter=100, area_depth=5, area_fanout=4, characters=500,
+                      locations_per_area=2, plot_length=400, seed=0):
+    rng = random.Random(seed)
+    areas = []
+    level = [None]
+    for depth in range(area_depth):
+        next_level = []
+        for parent_id in level:
+            for i in range(area_fanout if depth else area_fanout * 2):
+                area_id = f"area-{len(areas)}"
+                areas.append({"id": area_id, "name": f"エリア{depth}-{len(areas)}", "parent_id": parent_id, "level": depth})
+                next_level.append(area_id)
+        level = next_level
+    locations = [
+        {"id": f"loc-{i}", "name": f"場所{i}", "area_id": areas[i % len(areas)]["id"]}
+        for i in range(len(areas) * locations_per_area)
+    ]
+    chars = [{"id": f"00000000-0000-0000-0000-{i:012d}", "name": f"キャラ{i}"} for i in range(characters)]
+    sentence = "主人公は静かに扉を開け、見知らぬ部屋に足を踏み入れた。"
+    plots = []
+    for chapter in range(chapters):
+        for scene in range(scenes_per_chapter):
+            plots.append({
+                "id": f"{chapter:05d}-{scene:05d}",
+                "chapter_index": chapter,
+                "chapter_title": f"第{chapter}章",
+                "scene_index": scene,
+                "plot_text": (f"第{chapter}章{scene}場。" + sentence * (plot_length // len(sentence) + 1))[:plot_length],
+                "location": rng.choice(locations)["name"],
+                "mood": "/".join(rng.sample(MOODS, rng.randint(1, 3))),
+                "related_characters": [c["id"] for c in rng.sample(chars, min(len(chars), rng.randint(1, 5)))],
+                "related_context_ids": [],
+                "needs_indexing": True,
+                "version": 1
+            })
+    return {"location_areas": areas, "locations": locations, "characters": chars, "scenario_plots": plots}
+
+
+def _timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return {
+        "runs": repeat,
+        "p50_ms": metrics.percentile(samples, 0.5) * 1000,
+        "p99_ms": metrics.percentile(samples, 0.99) * 1000,
+        "total_s": sum(samples)
+    }
+
+
+# --- ページ表示 ---
+# Streamlit の再実行1回ぶんに相当する読み込みと、場所一覧の組み立て
+def bench_page_load(supabase, repeat):
+    def load(cold):
+        if cold:
+            data_access.invalidate()
+        page = data_access.load_page(supabase)
+        tree = page["area_tree"]
+        [tree.location_label(l) for l in tree.locations_in(tree.roots[0] if tree.roots else None)]
+
+    calls = supabase.calls
+    cold = _timed(lambda: load(True), repeat)
+    cold["supabase_calls_per_run"] = (supabase.calls - calls) / repeat
+    calls = supabase.calls
+    warm = _timed(lambda: load(False), repeat)
+    warm["supabase_calls_per_run"] = (supabase.calls - calls) / repeat
+    return {"page_load_cold": cold, "page_load_warm": warm}
+
+
+# --- 保存 ---
+def bench_save(supabase, repeat):
+    record = {
+        "chapter_index": 0, "chapter_title": "第0章", "scene_index": 0, "plot_text": "ベンチマーク用のシーン。",
+        "location": "", "mood": "希望", "related_characters": [], "related_context_ids": [], "needs_indexing": True
+    }
+    inserted = []
+
+    def insert():
+        inserted.append(data_access.insert_scene(supabase, record, auto_scene_index=True))
+
+    def update():
+        row = inserted[len(inserted) - 1]
+        saved = data_access.update_scene(supabase, row["id"], dict(record, scene_index=row["scene_index"]), row["version"])
+        inserted[len(inserted) - 1] = saved
+
+    return {"save_insert": _timed(insert, repeat), "save_update": _timed(update, repeat)}
+
+
+# --- 全件同期 ---
+def bench_sync(supabase, client, pinecone_latency, workers, batch_size):
+    index = FakeIndex(latency=pinecone_latency)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = EmbeddingCache(os.path.join(tmp, "cache.sqlite3"))
+        embedder = CachedEmbedder(BatchEmbedder(client, max_workers=workers, backoff_base=0.01), cache)
+        for label in ["sync_full", "sync_unchanged"]:
+            supabase.table("scenario_plots").update({"needs_indexing": True}).execute()
+            requests = client.requests
+            started = time.perf_counter()
+            stats = sync_dirty_records(supabase, index, embedder, batch_size=batch_size, cache=cache.for_target({"index": "benchmark", "namespace": "", "model": embedder.model}))
+            elapsed = time.perf_counter() - started
+            results[label] = {
+                "records": stats["records"],
+                "total_s": elapsed,
+                "records_per_s": stats["records"] / elapsed if elapsed else 0.0,
+                "embedding_requests": client.requests - requests,
+                "embed_batch_p50_ms": stats["embed_p50"] * 1000,
+                "embed_batch_p99_ms": stats["embed_p99"] * 1000,
+                "write_batch_p50_ms": stats["write_p50"] * 1000,
+                "write_batch_p99_ms": stats["write_p99"] * 1000
+            }
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Supabase/OpenAI/Pinecone をローカルの代替に置き換えたベンチマーク")
+    parser.add_argument("--chapters", type=int, default=20)
+    parser.add_argument("--scenes", type=int, default=100, help="章あたりのシーン数")
+    parser.add_argument("--area-depth", type=int, default=5)
+    parser.add_argument("--area-fanout", type=int, default=4)
+    parser.add_argument("--characters", type=int, default=500)
+    parser.add_argument("--supabase-latency", type=float, default=0.02)
+    parser.add_argument("--openai-latency", type=float, default=0.2)
+    parser.add_argument("--pinecone-latency", type=float, default=0.02)
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Supabase呼び出しの失敗率")
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="埋め込みAPIでN回に1回429を返す")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--skip", action="append", default=[], choices=["page", "save", "sync"])
+    parser.add_argument("--json", help="結果をJSONで書き出すパス（バージョン間の比較用）")
+    args = parser.parse_args(argv)
+
+    tables = generate_scenario(args.chapters, args.scenes, args.area_depth, args.area_fanout, args.characters)
+    supabase = FakeSupabase(tables, latency=args.supabase_latency, failure_rate=args.failure_rate)
+    client = FakeEmbeddingsClient(dimension=64, latency=args.openai_latency, rate_limit_every=args.rate_limit_every)
+
+    results = {"params": vars(args), "sizes": {name: len(rows) for name, rows in tables.items()}}
+    if "page" not in args.skip:
+        results.update(bench_page_load(supabase, args.repeat))
+    if "save" not in args.skip:
+        results.update(bench_save(supabase, args.repeat))
+    if "sync" not in args.skip:
+        results.update(bench_sync(supabase, client, args.pinecone_latency, args.workers, args.batch_size))
+
+    for name, values in results.items():
+        if name == "params":
+            continue
+        print(f"{name}: " + ", ".join(f"{k}={v:.2f}" if isinstance(v, float) else f"{k}={v}" for k, v in values.items()))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,149 @@
+import metrics
+from chunking import build_chunk_id, split_plot
+from data_access import iter_pages
+from pinecone_sync import SYNC_BATCH_SIZE, SYNC_COLUMNS, build_context_id, delete_stale_chunks, sync_batch
+from vector_target import load_left_seqs
+
+CHANGE_FEED_STATE = "pinecone"
+RECONCILE_PAGE_SIZE = 1000
+VECTOR_ID_PREFIX = "plot-ch"
+
+
+# --- 処理済み位置（indexer_state） ---
+def load_watermark(supabase, name=CHANGE_FEED_STATE):
+    rows = supabase.table("indexer_state").select("last_seq").eq("name", name).limit(1).execute().data
+    return rows[0]["last_seq"] if rows else 0
+
+
+def save_watermark(supabase, seq, name=CHANGE_FEED_STATE):
+    supabase.table("indexer_state").upsert({"name": name, "last_seq": seq}, on_conflict="name").execute()
+
+
+def delete_watermark(supabase, name):
+    supabase.table("indexer_state").delete().eq("name", name).execute()
+
+
+# --- 処理済みの変更履歴の削除 ---
+# indexer_state の各読み手（同期ワーカー・再埋め込みジョブ）と、切り戻し用の起点（vector_target.left:*）の
+# いちばん古い位置までは全員が読み終えているので、それ以前の行を消す。読み手がいなければ何も消さない
+def prune_changes(supabase):
+    seqs = [r["last_seq"] for r in supabase.table("indexer_state").select("last_seq").execute().data]
+    seqs += load_left_seqs(supabase)
+    if not seqs or min(seqs) <= 0:
+        return 0
+    with metrics.timer("supabase.prune_changes"):
+        deleted = supabase.table("scenario_plot_changes").delete().lte("seq", min(seqs)).execute().data
+    metrics.count("changes.pruned", len(deleted))
+    return len(deleted)
+
+
+# シーンのチャンクをすべて消す（"#" なしの旧IDも含む）
+def delete_context_vectors(index, context_ids, cache=None):
+    stale = delete_stale_chunks(index, {context_id: set() for context_id in context_ids}, cache)
+    if cache is not None:
+        cache.forget_indexed(stale)
+    return stale
+
+
+# --- 変更履歴の1ページを反映 ---
+# 同じシーンの変更はまとめて最新の状態だけを反映し、番号変更で使われなくなった旧IDは削除する
+def apply_changes(supabase, index, embedder, changes, cache=None, clear_flags=True, check_target=None):
+    old_ids = {}
+    for change in changes:
+        if change["old_context_id"]:
+            old_ids.setdefault(change["scene_id"], set()).add(change["old_context_id"])
+    scene_ids = list({c["scene_id"] for c in changes})
+    with metrics.timer("supabase.changed_rows"):
+        rows = supabase.table("scenario_plots").select(SYNC_COLUMNS).in_("id", scene_ids).execute().data
+    current = {str(r["id"]): r for r in rows}
+
+    stale_contexts = set()
+    for scene_id in scene_ids:
+        row = current.get(scene_id)
+        live_id = build_context_id(row["chapter_index"], row["scene_index"]) if row else None
+        # 削除済みのシーンは旧IDをすべて、残っているシーンは現在のID以外を消す
+        stale_contexts.update(cid for cid in old_ids.get(scene_id, ()) if cid != live_id)
+    if check_target:
+        check_target()
+    if stale_contexts:
+        delete_context_vectors(index, stale_contexts, cache)
+    if rows:
+        sync_batch(supabase, index, embedder, rows, cache, clear_flags=clear_flags, check_target=check_target)
+    return {"upserted": len(rows), "deleted": len(stale_contexts)}
+
+
+def process_changes(supabase, index, embedder, cache=None, batch_size=SYNC_BATCH_SIZE, on_batch=None, check_target=None):
+    stats = {"changes": 0, "upserted": 0, "deleted": 0, "batches": 0}
+    seq = load_watermark(supabase)
+    while True:
+        with metrics.timer("supabase.change_page"):
+            changes = supabase.table("scenario_plot_changes").select("seq, scene_id, op, old_context_id, new_context_id").gt("seq", seq).order("seq").limit(batch_size).execute().data
+        if not changes:
+            break
+        result = apply_changes(supabase, index, embedder, changes, cache, check_target=check_target)
+        # 反映が終わってから位置を進めるので、途中で落ちても次回は同じページからやり直す
+        seq = changes[-1]["seq"]
+        save_watermark(supabase, seq)
+        stats["changes"] += len(changes)
+        stats["upserted"] += result["upserted"]
+        stats["deleted"] += result["deleted"]
+        stats["batches"] += 1
+        if on_batch:
+            on_batch(stats)
+        if len(changes) < batch_size:
+            break
+    metrics.log_json("changes", **stats)
+    return stats
+
+
+# --- 突き合わせ（Supabase と ベクトルストアのずれを修復） ---
+# 各シーンの本文から現在のチャンクID（plot-ch{章}-{シーン}#{番号}）を求め、ベクトルIDを丸ごと比べる
+# 期待するIDに無いベクトル（削除済みシーン・"#" なしの旧ID・チャンク数が減って残った "#k"）は削除し、
+# チャンクが1つでも欠けているシーンはその場で索引し直す
+def reconcile(supabase, index, embedder, cache=None, page_size=RECONCILE_PAGE_SIZE, dry_run=False):
+    expected = {}
+    scenes = 0
+    for page in iter_pages(supabase, "id, chapter_index, scene_index, plot_text", page_size, timer="supabase.reconcile_page"):
+        for row in page:
+            context_id = build_context_id(row["chapter_index"], row["scene_index"])
+            for i in range(len(split_plot(row["plot_text"] or ""))):
+                expected[build_chunk_id(context_id, i)] = row["id"]
+        scenes += len(page)
+
+    seen = set()
+    orphans = []
+    stats = {"scenes": scenes, "orphans": 0, "legacy": 0, "missing": 0}
+
+    def drop(ids):
+        stats["orphans"] += len(ids)
+        if not dry_run and ids:
+            index.delete(ids=ids)
+            if cache is not None:
+                cache.forget_indexed(ids)
+
+    for ids in index.list(prefix=VECTOR_ID_PREFIX):
+        for vector_id in ids:
+            if vector_id in expected:
+                seen.add(vector_id)
+            else:
+                if "#" not in vector_id:
+                    stats["legacy"] += 1
+                orphans.append(vector_id)
+        if len(orphans) >= page_size:
+            drop(orphans)
+            orphans = []
+    drop(orphans)
+
+    unseen = [vector_id for vector_id in expected if vector_id not in seen]
+    missing = list({expected[vector_id] for vector_id in unseen})
+    stats["missing"] = len(missing)
+    if not dry_run:
+        # 索引済みとして覚えているとメタデータだけの更新になり、欠けたベクトルが戻らない
+        if cache is not None:
+            cache.forget_indexed(unseen)
+        for start in range(0, len(missing), SYNC_BATCH_SIZE):
+            rows = supabase.table("scenario_plots").select(SYNC_COLUMNS).in_("id", missing[start:start + SYNC_BATCH_SIZE]).execute().data
+            if rows:
+                sync_batch(supabase, index, embedder, rows, cache)
+    metrics.log_json("reconcile", dry_run=dry_run, **stats)
+    return stats
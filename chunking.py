@@ -0,0 +1,60 @@
+import re
+
+from embedding import estimate_tokens
+
+CHUNK_MAX_TOKENS = 500
+CHUNK_OVERLAP_TOKENS = 80
+
+# 句点・感嘆符・疑問符（後ろの閉じ括弧も含める）と改行で文を区切る
+SENTENCE_PATTERN = re.compile(r"[^。．！？!?\n]*(?:[。．！？!?]+[」』）)]*|\n|$)")
+
+
+def split_sentences(text):
+    return [s for s in SENTENCE_PATTERN.findall(text) if s.strip()]
+
+
+# 1文だけで上限を超える場合は文字数で切る
+def _hard_split(sentence, max_tokens):
+    parts = []
+    current = ""
+    for ch in sentence:
+        if current and estimate_tokens(current + ch) > max_tokens:
+            parts.append(current)
+            current = ""
+        current += ch
+    if current:
+        parts.append(current)
+    return parts
+
+
+# --- 長いプロットを重なり付きのチャンクに分割 ---
+def split_plot(text, max_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    if estimate_tokens(text) <= max_tokens:
+        return [text]
+    sentences = []
+    for sentence in split_sentences(text):
+        if estimate_tokens(sentence) > max_tokens:
+            sentences += _hard_split(sentence, max_tokens)
+        else:
+            sentences.append(sentence)
+
+    chunks = []
+    current = []
+    for sentence in sentences:
+        if current and estimate_tokens("".join(current) + sentence) > max_tokens:
+            chunks.append("".join(current).strip())
+            # 直前のチャンク末尾の文を重なりとして次のチャンクの先頭に引き継ぐ
+            overlap = []
+            for prev in reversed(current):
+                if estimate_tokens("".join([prev] + overlap) + sentence) > max_tokens or estimate_tokens("".join([prev] + overlap)) > overlap_tokens:
+                    break
+                overlap.insert(0, prev)
+            current = overlap
+        current.append(sentence)
+    if current:
+        chunks.append("".join(current).strip())
+    return chunks
+
+
+def build_chunk_id(context_id, chunk_index):
+    return f"{context_id}#{chunk_index}"
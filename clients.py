@@ -0,0 +1,37 @@
+import metrics
+
+# --- 外部サービスのクライアント ---
+# SDKの読み込みは重いので、実際に使うときまで import しない
+
+
+def create_supabase(url, key):
+    with metrics.timer("startup.supabase_client"):
+        from supabase import create_client
+        return create_client(url, key)
+
+
+def create_openai(api_key):
+    with metrics.timer("startup.openai_client"):
+        from openai import OpenAI
+        return OpenAI(api_key=api_key)
+
+
+def create_index(api_key, index_name):
+    with metrics.timer("startup.pinecone_index"):
+        from pinecone import Pinecone
+        return Pinecone(api_key=api_key).Index(index_name)
+
+
+# 名前空間は vector_target の読み書き先に合わせる
+def create_target_index(api_key, index_name, namespace=""):
+    from vector_target import NamespacedIndex
+
+    return NamespacedIndex(create_index(api_key, index_name), namespace)
+
+
+def create_embedder(api_key, model=None):
+    from embedding import BatchEmbedder, EMBEDDING_MODEL
+    from embedding_cache import CachedEmbedder, EmbeddingCache
+
+    cache = EmbeddingCache()
+    return CachedEmbedder(BatchEmbedder(create_openai(api_key), model=model or EMBEDDING_MODEL), cache), cache
@@ -0,0 +1,269 @@
+import difflib
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+from area_tree import AreaTree
+from scenario_model import CharacterIndex, Scenario, Scene
+import vector_target
+
+CACHE_TTL_SECONDS = 300
+CACHE_MAX_ENTRIES = 128
+SCENE_SEARCH_LIMIT = 50
+SCENARIO_PAGE_SIZE = 1000
+
+SCENE_INDEX_COLUMNS = "id, chapter_index, chapter_title, scene_index"
+# 本文を除いた全シーン分の列（章・キャラ・雰囲気ごとの索引に使う）
+SCENARIO_INDEX_COLUMNS = "id, chapter_index, chapter_title, scene_index, location, mood, related_characters, related_context_ids, version"
+SCENARIO_PLOT_COLUMNS = "chapter_title, chapter_index, id, scene_index, plot_text, location, mood, related_characters, related_context_ids, version"
+DIFF_FIELDS = ["chapter_title", "chapter_index", "scene_index", "plot_text", "location", "mood", "related_characters", "related_context_ids"]
+
+
+# --- TTL + LRU キャッシュ ---
+# モジュール変数として持つので、同じプロセスで動く全セッションで共有される
+class QueryCache:
+    def __init__(self, ttl=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.version = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                metrics.count("cache.hit")
+                return entry[1]
+            self.misses += 1
+            version = self.version
+        metrics.count("cache.miss")
+        with metrics.timer(_metric_name(key)):
+            value = loader()
+        with self._lock:
+            # 読み込み中に無効化された場合は古い結果を保存しない
+            if version == self.version:
+                self._entries[key] = (now + self.ttl, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, *tables):
+        with self._lock:
+            if tables:
+                for key in [k for k in self._entries if _key_tables(k) & set(tables)]:
+                    del self._entries[key]
+            else:
+                self._entries.clear()
+            self.version += 1
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "version": self.version}
+
+
+# キーの先頭要素は依存するテーブル名（複数テーブルから作る値はタプル）
+def _key_tables(key):
+    return set(key[0]) if isinstance(key[0], tuple) else {key[0]}
+
+
+# メトリクス名はキーの文字列部分から作る（検索語やIDは含めない）
+def _metric_name(key):
+    return "load." + ".".join(p for p in (key[0] if isinstance(key[0], tuple) else (key[0],)) + key[1:2] if isinstance(p, str))
+
+
+cache = QueryCache()
+
+
+def invalidate(*tables):
+    cache.invalidate(*tables)
+
+
+def cache_stats():
+    return cache.stats()
+
+
+# --- idのキーセットでページング ---
+# after から続きを読める。eq は {列: 値} の絞り込み
+def iter_pages(supabase, columns, page_size, table="scenario_plots", after=None, eq=None, timer="supabase.page"):
+    last_id = after
+    while True:
+        query = supabase.table(table).select(columns)
+        for column, value in (eq or {}).items():
+            query = query.eq(column, value)
+        if last_id is not None:
+            query = query.gt("id", last_id)
+        with metrics.timer(timer):
+            page = query.order("id").limit(page_size).execute().data
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        last_id = page[-1]["id"]
+
+
+# --- 読み出し ---
+def load_areas(supabase):
+    return cache.get_or_load(
+        ("location_areas",),
+        lambda: supabase.table("location_areas").select("id, name, parent_id, level").execute().data
+    )
+
+
+def load_locations(supabase):
+    return cache.get_or_load(
+        ("locations",),
+        lambda: supabase.table("locations").select("id, name, area_id").execute().data
+    )
+
+
+def load_characters(supabase):
+    return cache.get_or_load(
+        ("characters",),
+        lambda: supabase.table("characters").select("id, name").execute().data
+    )
+
+
+def load_area_tree(supabase):
+    return cache.get_or_load(
+        (("location_areas", "locations"), "area_tree"),
+        lambda: AreaTree(load_areas(supabase), load_locations(supabase))
+    )
+
+
+def load_character_index(supabase):
+    return cache.get_or_load(
+        ("characters", "index"),
+        lambda: CharacterIndex(load_characters(supabase))
+    )
+
+
+# --- シーン一覧（本文なしの Scenario、idのキーセットでページング） ---
+def load_scenario(supabase, page_size=SCENARIO_PAGE_SIZE):
+    def loader():
+        scenes = []
+        for page in iter_pages(supabase, SCENARIO_INDEX_COLUMNS, page_size, timer="supabase.scenario_page"):
+            scenes += [Scene.from_row(r) for r in page]
+        return Scenario(scenes)
+    return cache.get_or_load(("scenario_plots", "scenario"), loader)
+
+
+# --- 修正対象1件だけ本文まで読み込む ---
+def load_scene(supabase, scene_id):
+    def loader():
+        rows = supabase.table("scenario_plots").select(SCENARIO_PLOT_COLUMNS).eq("id", scene_id).limit(1).execute().data
+        return rows[0] if rows else None
+    return cache.get_or_load(("scenario_plots", "scene", scene_id), loader)
+
+
+# --- 本文のサーバー側検索 ---
+def search_scenes(supabase, text, chapter_index=None, limit=SCENE_SEARCH_LIMIT):
+    def loader():
+        query = supabase.table("scenario_plots").select(SCENE_INDEX_COLUMNS).ilike("plot_text", f"%{text}%")
+        if chapter_index is not None:
+            query = query.eq("chapter_index", chapter_index)
+        return [Scene.from_row(r) for r in query.order("chapter_index").order("scene_index").limit(limit).execute().data]
+    return cache.get_or_load(("scenario_plots", "search", text, chapter_index, limit), loader)
+
+
+# --- 類似シーン検索用のローカルベクトルインデックス ---
+# scenario_plots のキャッシュには入れない（保存のたびに全件作り直さないよう、モデルごとに持って差分更新する）
+# キャッシュが無効化されたときと有効期限ごとに、別スレッドで変わったシーンだけ反映する
+_vector_indexes = {}
+_vector_indexes_lock = threading.Lock()
+
+
+# 初回の索引は別スレッドで作るので、できあがるまでは None を返す
+def load_vector_index(supabase, embedder):
+    # NumPyの読み込みは検索を使うときまで遅らせる
+    from vector_search import IncrementalLocalIndex
+
+    with _vector_indexes_lock:
+        local_index = _vector_indexes.get(embedder.model)
+        if local_index is None:
+            local_index = _vector_indexes[embedder.model] = IncrementalLocalIndex(supabase, embedder)
+    return local_index.current((cache.version, int(time.monotonic() // CACHE_TTL_SECONDS)))
+
+
+# --- ベクトルの読み書き先（reembed.py の切り替えはキャッシュの有効期限内に反映される） ---
+# 検索や表示用。書き込む側は vector_target.load_active_target で毎回読み直す
+def load_active_target(supabase, index_name):
+    return cache.get_or_load(
+        ("app_config", "vector_target"),
+        lambda: vector_target.load_active_target(supabase, index_name)
+    )
+
+
+# --- 分析ページの集計（どのテーブルが更新されても作り直す） ---
+def load_analytics(supabase):
+    from analytics import ScenarioAnalytics
+
+    return cache.get_or_load(
+        (("scenario_plots", "characters", "location_areas", "locations"), "analytics"),
+        lambda: ScenarioAnalytics(load_scenario(supabase), load_character_index(supabase), load_area_tree(supabase))
+    )
+
+
+# --- 画面表示に必要なデータをまとめて読む（Streamlitなしでも呼べる） ---
+def load_page(supabase):
+    characters = load_character_index(supabase)
+    scenario = load_scenario(supabase)
+    return {
+        "area_tree": load_area_tree(supabase),
+        "characters": characters,
+        "char_dict": characters.char_dict,
+        "scenario": scenario,
+        "chapter_title_map": scenario.chapter_title_map
+    }
+
+
+# --- 書き込み（楽観的排他制御） ---
+class StaleWriteError(Exception):
+    def __init__(self, current):
+        super().__init__("他のユーザーが先に更新しています")
+        self.current = current
+
+
+# 読み込んだ時点の version と一致する場合だけ更新する。一致しなければ最新のレコードを添えて StaleWriteError
+# version の加算はDB側のトリガーで行う（sql/001_scene_versioning.sql）
+def update_scene(supabase, scene_id, record, base_version):
+    with metrics.timer("supabase.update_scene"):
+        updated = supabase.table("scenario_plots").update(record).eq("id", scene_id).eq("version", base_version).execute().data
+    invalidate("scenario_plots")
+    if not updated:
+        rows = supabase.table("scenario_plots").select(SCENARIO_PLOT_COLUMNS).eq("id", scene_id).limit(1).execute().data
+        raise StaleWriteError(rows[0] if rows else None)
+    return updated[0]
+
+
+# シーン番号はDB側の allocate_scene_index で確保する（sql/001_scene_versioning.sql）
+def allocate_scene_index(supabase, chapter_index):
+    with metrics.timer("supabase.allocate_scene_index"):
+        return supabase.rpc("allocate_scene_index", {"p_chapter_index": chapter_index}).execute().data
+
+
+def insert_scene(supabase, record, auto_scene_index=False):
+    if auto_scene_index:
+        record = dict(record, scene_index=allocate_scene_index(supabase, record["chapter_index"]))
+    with metrics.timer("supabase.insert_scene"):
+        inserted = supabase.table("scenario_plots").insert(record).execute().data
+    invalidate("scenario_plots")
+    return inserted[0] if inserted else record
+
+
+def record_diff(old, new, fields=DIFF_FIELDS):
+    lines = []
+    for field in fields:
+        a = str(old.get(field, "")).splitlines()
+        b = str(new.get(field, "")).splitlines()
+        if a != b:
+            lines += difflib.unified_diff(a, b, fromfile=f"{field}（最新）", tofile=f"{field}（あなたの編集）", lineterm="")
+    return "\n".join(lines)
@@ -0,0 +1,238 @@
+import hashlib
+import math
+import random
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# OpenAI embeddings API の上限（1リクエストあたり）
+MAX_INPUTS_PER_REQUEST = 2048
+MAX_TOKENS_PER_REQUEST = 300000
+MAX_TOKENS_PER_INPUT = 8191
+
+
+# --- トークン数の見積もり ---
+# tiktoken を使わずに安全側に見積もる（日本語はおおむね1文字1トークン、英語は3〜4文字で1トークン）
+def estimate_tokens(text):
+    return len(text.encode("utf-8")) // 3 + 1
+
+
+# --- バッチ分割 ---
+def plan_batches(texts, max_inputs=MAX_INPUTS_PER_REQUEST, max_tokens=MAX_TOKENS_PER_REQUEST):
+    batches = []
+    current = []
+    current_tokens = 0
+    for i, text in enumerate(texts):
+        tokens = min(estimate_tokens(text), MAX_TOKENS_PER_INPUT)
+        if current and (len(current) >= max_inputs or current_tokens + tokens > max_tokens):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def is_rate_limit_error(e):
+    status = getattr(e, "status_code", None) or getattr(getattr(e, "response", None), "status_code", None)
+    return status == 429 or type(e).__name__ == "RateLimitError"
+
+
+# --- 並列バッチ埋め込み ---
+class BatchEmbedder:
+    def __init__(self, client, model=EMBEDDING_MODEL, max_inputs=256, max_tokens=MAX_TOKENS_PER_REQUEST,
+                 max_workers=4, max_retries=6, backoff_base=1.0, backoff_max=60.0):
+        self.client = client
+        self.model = model
+        self.max_inputs = max_inputs
+        self.max_tokens = max_tokens
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def _request(self, inputs):
+        attempt = 0
+        while True:
+            try:
+                with metrics.timer("openai.embeddings"):
+                    response = self.client.embeddings.create(input=inputs, model=self.model)
+                break
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt >= self.max_retries:
+                    raise
+                metrics.count("openai.rate_limited")
+                delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+                time.sleep(delay * random.uniform(0.5, 1.0))
+                attempt += 1
+        metrics.count("openai.embedded_inputs", len(inputs))
+        # レスポンスの順序は index で保証されるので並べ直す
+        return [d.embedding for d in sorted(response.data, key=lambda d: d.index)]
+
+    def embed(self, texts):
+        texts = list(texts)
+        if not texts:
+            return []
+        batches = plan_batches(texts, self.max_inputs, self.max_tokens)
+        results = [None] * len(texts)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = [(batch, pool.submit(self._request, [texts[i] for i in batch])) for batch in batches]
+            for batch, future in futures:
+                for i, vector in zip(batch, future.result()):
+                    results[i] = vector
+        return results
+
+
+# --- トークン予算（1分あたり） ---
+# トークンバケット方式。1回で予算を超える要求はバケットが満タンになるまで待ってから通す
+class TokenBudget:
+    def __init__(self, tokens_per_minute, clock=time.monotonic, sleep=time.sleep):
+        self.tokens_per_minute = tokens_per_minute
+        self.clock = clock
+        self.sleep = sleep
+        self.available = float(tokens_per_minute)
+        self.updated = clock()
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.available = min(self.tokens_per_minute, self.available + (now - self.updated) * self.tokens_per_minute / 60)
+        self.updated = now
+
+    def acquire(self, tokens):
+        with self._lock:
+            self._refill()
+            needed = min(tokens, self.tokens_per_minute)
+            if self.available < needed:
+                delay = (needed - self.available) * 60 / self.tokens_per_minute
+                self.sleep(delay)
+                self.waited += delay
+                self._refill()
+            self.available -= tokens
+
+
+# 埋め込みAPIに送る分だけ予算を消費する（CachedEmbedder の内側に置けばキャッシュヒットは数えない）
+class ThrottledEmbedder:
+    def __init__(self, embedder, budget):
+        self.embedder = embedder
+        self.budget = budget
+        self.model = embedder.model
+        self.tokens = 0
+
+    def embed(self, texts):
+        texts = list(texts)
+        tokens = sum(min(estimate_tokens(t), MAX_TOKENS_PER_INPUT) for t in texts)
+        self.budget.acquire(tokens)
+        self.tokens += tokens
+        return self.embedder.embed(texts)
+
+
+# --- オフライン計測用のフェイククライアント ---
+class _FakeEmbedding:
+    def __init__(self, index, embedding):
+        self.index = index
+        self.embedding = embedding
+
+
+class _FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeRateLimitError(Exception):
+    status_code = 429
+
+
+class _FakeEmbeddings:
+    def __init__(self, owner):
+        self.owner = owner
+
+    def create(self, input, model):
+        return self.owner._create(input, model)
+
+
+class FakeEmbeddingsClient:
+    def __init__(self, dimension=1536, latency=0.05, per_input_latency=0.0, rate_limit_every=0):
+        self.dimension = dimension
+        self.latency = latency
+        self.per_input_latency = per_input_latency
+        self.rate_limit_every = rate_limit_every
+        self.embeddings = _FakeEmbeddings(self)
+        self.requests = 0
+        self.inputs = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def _vector(self, text):
+        # テキストから決定的なベクトルを作る
+        seed = hashlib.sha256(text.encode("utf-8")).digest()
+        values = []
+        counter = 0
+        while len(values) < self.dimension:
+            block = hashlib.sha256(seed + struct.pack("<I", counter)).digest()
+            values.extend(b / 127.5 - 1.0 for b in block)
+            counter += 1
+        values = values[:self.dimension]
+        norm = math.sqrt(sum(v * v for v in values)) or 1.0
+        return [v / norm for v in values]
+
+    def _create(self, input, model):
+        with self._lock:
+            self.requests += 1
+            n = self.requests
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.latency + self.per_input_latency * len(input))
+            if self.rate_limit_every and n % self.rate_limit_every == 0:
+                raise FakeRateLimitError("rate limited")
+            with self._lock:
+                self.inputs += len(input)
+            data = [_FakeEmbedding(i, self._vector(text)) for i, text in enumerate(input)]
+            # 実APIと同様に順不同で返ることを想定してシャッフルしておく
+            random.shuffle(data)
+            return _FakeResponse(data)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+# --- スループット計測 ---
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="埋め込みパイプラインのオフライン計測")
+    parser.add_argument("--texts", type=int, default=3000)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--rate-limit-every", type=int, default=0)
+    args = parser.parse_args()
+
+    texts = [f"シーン{i}のプロット本文。" * 20 for i in range(args.texts)]
+
+    baseline = FakeEmbeddingsClient(dimension=8, latency=args.latency)
+    start = time.perf_counter()
+    for text in texts[:50]:
+        baseline.embeddings.create(input=[text], model=EMBEDDING_MODEL)
+    sequential = (time.perf_counter() - start) / 50 * len(texts)
+
+    fake = FakeEmbeddingsClient(dimension=8, latency=args.latency, rate_limit_every=args.rate_limit_every)
+    embedder = BatchEmbedder(fake, max_inputs=args.batch_size, max_workers=args.workers, backoff_base=0.01)
+    start = time.perf_counter()
+    vectors = embedder.embed(texts)
+    elapsed = time.perf_counter() - start
+    assert vectors == [fake._vector(t) for t in texts]
+
+    print(f"1件ずつ（推定）: {sequential:.2f}s")
+    print(f"バッチ並列: {elapsed:.2f}s / {len(texts) / elapsed:.0f} texts/s")
+    print(f"リクエスト数: {fake.requests}, 最大同時実行: {fake.max_in_flight}")
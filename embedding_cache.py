@@ -0,0 +1,182 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+
+from embedding import EMBEDDING_MODEL
+from vector_target import target_label
+
+EMBEDDING_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".embedding_cache.sqlite3")
+EMBEDDING_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+
+def cache_key(text, model=EMBEDDING_MODEL):
+    return hashlib.sha256(f"{model}\n{text}".encode("utf-8")).hexdigest()
+
+
+def _pack(vector):
+    return array("f", vector).tobytes()
+
+
+def _unpack(blob):
+    values = array("f")
+    values.frombytes(blob)
+    return values.tolist()
+
+
+# --- 永続埋め込みキャッシュ（SQLite） ---
+# embeddings: チャンク本文+モデルのハッシュ → ベクトル
+# indexed: 読み書き先ごとに、PineconeのベクトルIDに現在どのハッシュの内容が入っているか
+# （切り戻した読み書き先に、別の読み書き先で書いた内容を前提にしたメタデータだけの更新を送らないよう、読み書き先で分ける）
+class EmbeddingCache:
+    def __init__(self, path=EMBEDDING_CACHE_PATH, max_bytes=EMBEDDING_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used)")
+        # 読み書き先の列が無い旧形式は、どの読み書き先の内容か分からないので作り直す（次の同期で埋め込みキャッシュから書き直される）
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(indexed)").fetchall()]
+        if columns and "target" not in columns:
+            self._conn.execute("DROP TABLE indexed")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS indexed ("
+            "target TEXT NOT NULL, vector_id TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (target, vector_id))"
+        )
+        self._conn.commit()
+
+    # raw=True ならベクトルを展開せず float32 のバイト列のまま返す（NumPy側で frombuffer する）
+    def get_many(self, keys, raw=False):
+        keys = list(set(keys))
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                part = keys[start:start + 500]
+                marks = ",".join("?" * len(part))
+                rows = self._conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({marks})", part).fetchall()
+                found.update((key, blob if raw else _unpack(blob)) for key, blob in rows)
+            if found:
+                now = time.time()
+                self._conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, k) for k in found])
+                self._conn.commit()
+        return found
+
+    def put_many(self, items):
+        now = time.time()
+        rows = []
+        for key, vector in items:
+            blob = _pack(vector)
+            rows.append((key, blob, len(blob), now))
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+        while total > self.max_bytes:
+            rows = self._conn.execute("SELECT key, size FROM embeddings ORDER BY last_used LIMIT 1000").fetchall()
+            if not rows:
+                break
+            victims = []
+            for key, size in rows:
+                victims.append((key,))
+                total -= size
+                if total <= self.max_bytes:
+                    break
+            self._conn.executemany("DELETE FROM embeddings WHERE key = ?", victims)
+
+    def indexed_keys(self, target, vector_ids):
+        vector_ids = list(vector_ids)
+        found = {}
+        with self._lock:
+            for start in range(0, len(vector_ids), 500):
+                part = vector_ids[start:start + 500]
+                marks = ",".join("?" * len(part))
+                found.update(self._conn.execute(
+                    f"SELECT vector_id, key FROM indexed WHERE target = ? AND vector_id IN ({marks})", [target] + part
+                ).fetchall())
+        return found
+
+    def mark_indexed(self, target, pairs):
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO indexed VALUES (?, ?, ?)", [(target, v, k) for v, k in pairs])
+            self._conn.commit()
+
+    def forget_indexed(self, target, vector_ids):
+        with self._lock:
+            self._conn.executemany("DELETE FROM indexed WHERE target = ? AND vector_id = ?", [(target, v) for v in vector_ids])
+            self._conn.commit()
+
+    # シーン（context_id）ごとに、書き込み済みのチャンクID（"{context_id}#k"）を返す。一度も書いていないシーンは含まない
+    # "#" の次の文字 "$" までの範囲で引くので、主キーの索引だけで済む
+    def indexed_ids(self, target, context_ids):
+        found = {}
+        with self._lock:
+            for context_id in context_ids:
+                rows = self._conn.execute(
+                    "SELECT vector_id FROM indexed WHERE target = ? AND vector_id >= ? AND vector_id < ?",
+                    (target, f"{context_id}#", f"{context_id}$")
+                ).fetchall()
+                if rows:
+                    found[context_id] = [row[0] for row in rows]
+        return found
+
+    # 同期処理に渡す、1つの読み書き先に絞った indexed
+    def for_target(self, target):
+        return TargetIndexed(self, target_label(target))
+
+
+class TargetIndexed:
+    def __init__(self, cache, target):
+        self.cache = cache
+        self.target = target
+
+    def indexed_keys(self, vector_ids):
+        return self.cache.indexed_keys(self.target, vector_ids)
+
+    def mark_indexed(self, pairs):
+        self.cache.mark_indexed(self.target, pairs)
+
+    def forget_indexed(self, vector_ids):
+        self.cache.forget_indexed(self.target, vector_ids)
+
+    def indexed_ids(self, context_ids):
+        return self.cache.indexed_ids(self.target, context_ids)
+
+
+# --- キャッシュ付きエンベッダー（BatchEmbedder と同じインターフェース） ---
+class CachedEmbedder:
+    def __init__(self, embedder, cache):
+        self.embedder = embedder
+        self.cache = cache
+        self.model = embedder.model
+        self.hits = 0
+        self.misses = 0
+
+    def _embed(self, texts, raw):
+        texts = list(texts)
+        keys = [cache_key(t, self.model) for t in texts]
+        cached = self.cache.get_many(keys, raw=raw)
+        missing = [i for i, k in enumerate(keys) if k not in cached]
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            vectors = self.embedder.embed([texts[i] for i in missing])
+            fresh = {keys[i]: v for i, v in zip(missing, vectors)}
+            self.cache.put_many(fresh.items())
+            cached.update((k, _pack(v)) if raw else (k, v) for k, v in fresh.items())
+        return [cached[k] for k in keys]
+
+    def embed(self, texts):
+        return self._embed(texts, raw=False)
+
+    # float32 のバイト列で返す（ローカルインデックスで Python の float リストを作らずに済む）
+    def embed_blobs(self, texts):
+        return self._embed(texts, raw=True)
@@ -0,0 +1,376 @@
+import copy
+import math
+import random
+import re
+import threading
+import time
+import uuid
+
+from embedding import FakeEmbeddingsClient, FakeRateLimitError
+
+
+# --- Supabase / Pinecone / OpenAI のローカル代替（ベンチマーク・オフライン検証用） ---
+class FakeServiceError(Exception):
+    pass
+
+
+# PostgREST の APIError と同じく code と message を持つ（23505 は一意制約違反）
+class FakeUniqueViolation(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+        self.code = "23505"
+        self.message = message
+
+
+class _Latency:
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.calls = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _call(self, name):
+        with self._lock:
+            self.calls += 1
+            fail = self.failure_rate and self._random.random() < self.failure_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            raise FakeServiceError(f"{name}: injected failure")
+
+
+class _Response:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+class _Query:
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+        self.action = "select"
+        self.columns = None
+        self.payload = None
+        self.filters = []
+        self.orders = []
+        self.limit_count = None
+        self.range_bounds = None
+        self.count = None
+
+    # 取得・書き込み
+    def select(self, columns="*", count=None):
+        self.action = "select"
+        self.count = count
+        self.columns = None if columns.strip() == "*" else [c.strip() for c in columns.split(",")]
+        return self
+
+    def insert(self, rows):
+        self.action = "insert"
+        self.payload = rows
+        return self
+
+    def upsert(self, rows, on_conflict="id"):
+        self.action = "upsert"
+        self.payload = rows
+        self.on_conflict = [c.strip() for c in on_conflict.split(",")]
+        return self
+
+    def update(self, values):
+        self.action = "update"
+        self.payload = values
+        return self
+
+    def delete(self):
+        self.action = "delete"
+        return self
+
+    # 条件
+    def _filter(self, predicate):
+        self.filters.append(predicate)
+        return self
+
+    def eq(self, column, value):
+        return self._filter(lambda r: r.get(column) == value)
+
+    def neq(self, column, value):
+        return self._filter(lambda r: r.get(column) != value)
+
+    def gt(self, column, value):
+        return self._filter(lambda r: r.get(column) is not None and r.get(column) > value)
+
+    def gte(self, column, value):
+        return self._filter(lambda r: r.get(column) is not None and r.get(column) >= value)
+
+    def lt(self, column, value):
+        return self._filter(lambda r: r.get(column) is not None and r.get(column) < value)
+
+    def lte(self, column, value):
+        return self._filter(lambda r: r.get(column) is not None and r.get(column) <= value)
+
+    def in_(self, column, values):
+        values = set(values)
+        return self._filter(lambda r: r.get(column) in values)
+
+    def is_(self, column, value):
+        return self._filter(lambda r: r.get(column) is None if value in (None, "null") else r.get(column) == value)
+
+    def like(self, column, pattern):
+        regex = re.compile("^" + re.escape(pattern).replace("%", ".*").replace("_", ".") + "$", re.S)
+        return self._filter(lambda r: regex.match(str(r.get(column) or "")) is not None)
+
+    def ilike(self, column, pattern):
+        needle = pattern.strip("%").lower()
+        return self._filter(lambda r: needle in str(r.get(column) or "").lower())
+
+    def order(self, column, desc=False):
+        self.orders.append((column, desc))
+        return self
+
+    def limit(self, count):
+        self.limit_count = count
+        return self
+
+    def range(self, start, end):
+        self.range_bounds = (start, end)
+        return self
+
+    def _project(self, row):
+        if self.columns is None:
+            return copy.deepcopy(row)
+        return {c: copy.deepcopy(row.get(c)) for c in self.columns}
+
+    def execute(self):
+        self.db._call(f"{self.table}.{self.action}")
+        with self.db.lock:
+            rows = self.db.tables.setdefault(self.table, [])
+            if self.action == "insert":
+                return _Response(self.db._insert(self.table, self.payload))
+            if self.action == "upsert":
+                return _Response(self.db._upsert(self.table, self.payload, self.on_conflict))
+            matched = [r for r in rows if all(f(r) for f in self.filters)]
+            if self.action == "update":
+                for row in matched:
+                    row.update(self.db._before_update(self.table, row, copy.deepcopy(self.payload)))
+                return _Response(copy.deepcopy(matched))
+            if self.action == "delete":
+                ids = {id(r) for r in matched}
+                self.db.tables[self.table] = [r for r in rows if id(r) not in ids]
+                return _Response(copy.deepcopy(matched))
+            total = len(matched) if self.count else None
+            for column, desc in reversed(self.orders):
+                matched.sort(key=lambda r: (r.get(column) is None, r.get(column)), reverse=desc)
+            if self.range_bounds:
+                matched = matched[self.range_bounds[0]:self.range_bounds[1] + 1]
+            if self.limit_count is not None:
+                matched = matched[:self.limit_count]
+            return _Response([self._project(r) for r in matched], total)
+
+
+class _Rpc:
+    def __init__(self, db, name, params):
+        self.db = db
+        self.name = name
+        self.params = params
+
+    def execute(self):
+        self.db._call(f"rpc.{self.name}")
+        with self.db.lock:
+            return _Response(self.db.functions[self.name](self.db, **self.params))
+
+
+# sql/001_scene_versioning.sql の allocate_scene_index と同じ振る舞い
+def _allocate_scene_index(db, p_chapter_index):
+    counters = db.tables.setdefault("chapter_scene_counters", [])
+    current = max((r["scene_index"] for r in db.tables.get("scenario_plots", []) if r["chapter_index"] == p_chapter_index), default=-1) + 1
+    for row in counters:
+        if row["chapter_index"] == p_chapter_index:
+            allocated = max(row["next_scene_index"], current)
+            row["next_scene_index"] = allocated + 1
+            return allocated
+    counters.append({"chapter_index": p_chapter_index, "next_scene_index": current + 1})
+    return current
+
+
+# sql/001_scene_versioning.sql の bump_scenario_plot_version と同じ振る舞い（更新前の行と更新内容から version を決める）
+VERSIONED_COLUMNS = ["chapter_index", "scene_index", "chapter_title", "plot_text", "location", "mood",
+                     "related_characters", "related_context_ids"]
+
+
+def _bump_version(old, values):
+    new = dict(old, **values)
+    changed = any(old.get(c) != new.get(c) for c in VERSIONED_COLUMNS)
+    return dict(values, version=old.get("version", 1) + 1 if changed else old.get("version", 1))
+
+
+class FakeSupabase(_Latency):
+    def __init__(self, tables=None, latency=0.0, failure_rate=0.0, seed=0):
+        super().__init__(latency, failure_rate, seed)
+        self.tables = tables if tables is not None else {}
+        self.lock = threading.RLock()
+        self.functions = {"allocate_scene_index": _allocate_scene_index}
+        self.defaults = {"scenario_plots": {"version": 1, "needs_indexing": True}}
+        self.before_update = {"scenario_plots": _bump_version}
+        # sql/001_scene_versioning.sql の一意インデックス
+        self.unique = {"scenario_plots": [("chapter_index", "scene_index")]}
+
+    def table(self, name):
+        return _Query(self, name)
+
+    def rpc(self, name, params=None):
+        return _Rpc(self, name, params or {})
+
+    def _new_row(self, table, row):
+        new = dict(self.defaults.get(table, {}))
+        new.update(copy.deepcopy(row))
+        new.setdefault("id", str(uuid.uuid4()))
+        return new
+
+    def _before_update(self, table, old, values):
+        hook = self.before_update.get(table)
+        return hook(old, values) if hook else values
+
+    # 書き込み後の行（replaced は上書きされる既存行）で一意制約を確かめる。違反があれば何も書かずに例外（1文で全件ロールバック）
+    def _check_unique(self, table, replaced, rows):
+        replaced_ids = {id(r) for r in replaced}
+        for columns in self.unique.get(table, []):
+            seen = {tuple(r.get(c) for c in columns) for r in self.tables[table] if id(r) not in replaced_ids}
+            for row in rows:
+                key = tuple(row.get(c) for c in columns)
+                if key in seen:
+                    raise FakeUniqueViolation(f"duplicate key value violates unique constraint ({', '.join(columns)})=({', '.join(map(str, key))})")
+                seen.add(key)
+
+    def _insert(self, table, payload):
+        rows = payload if isinstance(payload, list) else [payload]
+        created = [self._new_row(table, r) for r in rows]
+        self._check_unique(table, [], created)
+        self.tables[table].extend(created)
+        return copy.deepcopy(created)
+
+    def _upsert(self, table, payload, on_conflict):
+        rows = payload if isinstance(payload, list) else [payload]
+        existing = {tuple(r.get(c) for c in on_conflict): r for r in self.tables[table]}
+        planned = []
+        for row in rows:
+            target = existing.get(tuple(row.get(c) for c in on_conflict))
+            if target is None:
+                planned.append((None, self._new_row(table, row)))
+            else:
+                planned.append((target, dict(target, **self._before_update(table, target, copy.deepcopy(row)))))
+        self._check_unique(table, [t for t, _ in planned if t is not None], [new for _, new in planned])
+        written = []
+        for target, new in planned:
+            if target is None:
+                self.tables[table].append(new)
+            else:
+                target.update(new)
+            written.append(copy.deepcopy(new))
+        return written
+
+
+# --- Pinecone.Index の代替 ---
+class _Match:
+    def __init__(self, id, score, metadata, values=None):
+        self.id = id
+        self.score = score
+        self.metadata = metadata
+        self.values = values
+
+
+class _QueryResponse:
+    def __init__(self, matches):
+        self.matches = matches
+
+
+class _FetchResponse:
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+
+def _matches_filter(metadata, conditions):
+    for field, condition in (conditions or {}).items():
+        value = metadata.get(field)
+        values = value if isinstance(value, list) else [value]
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        for op, expected in condition.items():
+            if op == "$eq" and expected not in values:
+                return False
+            if op == "$in" and not set(values) & set(expected):
+                return False
+            if op == "$ne" and expected in values:
+                return False
+    return True
+
+
+class FakeIndex(_Latency):
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=0):
+        super().__init__(latency, failure_rate, seed)
+        self.namespaces = {}
+        self.lock = threading.Lock()
+
+    def _ns(self, namespace):
+        return self.namespaces.setdefault(namespace or "", {})
+
+    def upsert(self, vectors, namespace=""):
+        self._call("upsert")
+        with self.lock:
+            store = self._ns(namespace)
+            for v in vectors:
+                store[v["id"]] = {"values": list(v["values"]), "metadata": copy.deepcopy(v.get("metadata", {}))}
+        return {"upserted_count": len(vectors)}
+
+    def update(self, id, values=None, set_metadata=None, namespace=""):
+        self._call("update")
+        with self.lock:
+            entry = self._ns(namespace).get(id)
+            if entry is None:
+                return {}
+            if values is not None:
+                entry["values"] = list(values)
+            if set_metadata:
+                entry["metadata"].update(copy.deepcopy(set_metadata))
+        return {}
+
+    def delete(self, ids=None, namespace="", delete_all=False):
+        self._call("delete")
+        with self.lock:
+            store = self._ns(namespace)
+            if delete_all:
+                store.clear()
+            for vid in ids or []:
+                store.pop(vid, None)
+        return {}
+
+    def list(self, prefix="", namespace="", limit=100):
+        self._call("list")
+        with self.lock:
+            ids = sorted(vid for vid in self._ns(namespace) if vid.startswith(prefix))
+        for start in range(0, len(ids), limit):
+            yield ids[start:start + limit]
+
+    def fetch(self, ids, namespace=""):
+        self._call("fetch")
+        with self.lock:
+            store = self._ns(namespace)
+            return _FetchResponse({vid: _Match(vid, 0.0, store[vid]["metadata"], store[vid]["values"]) for vid in ids if vid in store})
+
+    def query(self, vector, top_k=10, filter=None, include_metadata=True, namespace=""):
+        self._call("query")
+        norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+        with self.lock:
+            scored = []
+            for vid, entry in self._ns(namespace).items():
+                if not _matches_filter(entry["metadata"], filter):
+                    continue
+                values = entry["values"]
+                score = sum(a * b for a, b in zip(vector, values)) / (norm * (math.sqrt(sum(x * x for x in values)) or 1.0))
+                scored.append(_Match(vid, score, copy.deepcopy(entry["metadata"]) if include_metadata else None))
+        scored.sort(key=lambda m: -m.score)
+        return _QueryResponse(scored[:top_k])
+
+    def describe_index_stats(self):
+        with self.lock:
+            return {"namespaces": {ns: {"vector_count": len(store)} for ns, store in self.namespaces.items()}}
@@ -0,0 +1,244 @@
+import argparse
+import fcntl
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from dotenv import load_dotenv
+
+from embedding import BatchEmbedder, estimate_tokens
+from embedding_cache import CachedEmbedder, EmbeddingCache
+import clients
+import metrics
+from change_feed import process_changes, prune_changes, reconcile
+from pinecone_sync import SYNC_BATCH_SIZE, build_chunk_text, iter_dirty_pages, sync_dirty_records
+from vector_target import TargetChangedError, load_active_target, target_guard, target_label
+
+INDEXER_LOCK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".indexer.lock")
+INDEXER_LOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".indexer.log")
+WATCH_INTERVAL_SECONDS = 30
+SETTING_KEYS = ["SUPABASE_URL", "SUPABASE_KEY", "OPENAI_API_KEY", "PINECONE_API_KEY", "PINECONE_INDEX_NAME"]
+
+
+# --- 多重起動防止（ロックファイルの flock） ---
+# ロックはファイルを開いている間だけ保持され、プロセスが落ちればOSが解放する。ファイル自体は消さない
+# PIDはログ調査用に書いておくだけで、判定には使わない
+_held_locks = {}
+
+
+def is_running(lock_path=INDEXER_LOCK_PATH):
+    try:
+        f = open(lock_path)
+    except FileNotFoundError:
+        return False
+    with f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        fcntl.flock(f, fcntl.LOCK_UN)
+        return False
+
+
+def acquire_lock(lock_path=INDEXER_LOCK_PATH):
+    f = open(lock_path, "a+")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return False
+    f.seek(0)
+    f.truncate()
+    f.write(str(os.getpid()))
+    f.flush()
+    _held_locks[lock_path] = f
+    return True
+
+
+def release_lock(lock_path=INDEXER_LOCK_PATH):
+    f = _held_locks.pop(lock_path, None)
+    if f is None:
+        return
+    f.truncate(0)
+    fcntl.flock(f, fcntl.LOCK_UN)
+    f.close()
+
+
+# --- Streamlit側からワーカーを起動する ---
+# 別プロセスで走らせるので、タブを閉じても同期は続く
+def trigger_worker(settings):
+    if is_running():
+        return False
+    env = dict(os.environ)
+    env.update({k: str(settings[k]) for k in SETTING_KEYS})
+    with open(INDEXER_LOG_PATH, "a") as log:
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--once", "--source", "changes"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=env,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            start_new_session=True
+        )
+    return True
+
+
+def read_log_tail(lines=20):
+    try:
+        with open(INDEXER_LOG_PATH) as f:
+            return "".join(f.readlines()[-lines:])
+    except FileNotFoundError:
+        return ""
+
+
+# --- クライアント作成 ---
+def load_settings():
+    load_dotenv()
+    missing = [k for k in SETTING_KEYS if not os.environ.get(k)]
+    if missing:
+        raise SystemExit(f"環境変数が設定されていません: {', '.join(missing)}")
+    return {k: os.environ[k] for k in SETTING_KEYS}
+
+
+def create_target_index(settings, target):
+    return clients.create_target_index(settings["PINECONE_API_KEY"], target["index"], target["namespace"])
+
+
+# 書き込み先は app_config の現在の読み書き先（reembed.py で切り替わる）
+def create_clients(settings):
+    supabase = clients.create_supabase(settings["SUPABASE_URL"], settings["SUPABASE_KEY"])
+    client = clients.create_openai(settings["OPENAI_API_KEY"])
+    target = load_active_target(supabase, settings["PINECONE_INDEX_NAME"])
+    return supabase, client, create_target_index(settings, target), target
+
+
+# --- 実行モード ---
+def dry_run(supabase, batch_size):
+    records = 0
+    tokens = 0
+    for page in iter_dirty_pages(supabase, batch_size):
+        records += len(page)
+        tokens += sum(estimate_tokens(build_chunk_text(r["plot_text"], r["location"], r["mood"])) for r in page)
+    print(f"[dry-run] 同期対象 {records}件 / 推定 {tokens}トークン")
+    return records
+
+
+# 変更履歴を反映したあと、履歴に載っていない needs_indexing の行（変更履歴の導入前の編集など）も拾う
+# 最後に、どの読み手にも要らなくなった変更履歴を消す
+def run_changes(supabase, index, embedder, cache, batch_size, check_target=None):
+    stats = process_changes(
+        supabase, index, embedder, cache=cache, batch_size=batch_size, check_target=check_target,
+        on_batch=lambda s: print(f"{s['changes']}件の変更を反映（{s['batches']}バッチ）", flush=True)
+    )
+    print(f"変更反映完了: 変更 {stats['changes']}件 / 索引 {stats['upserted']}件 / 削除 {stats['deleted']}件", flush=True)
+    leftover = sync_dirty_records(supabase, index, embedder, batch_size=batch_size, cache=cache, check_target=check_target)
+    if leftover["records"]:
+        print(f"変更履歴にない同期対象: {leftover['records']}件", flush=True)
+    pruned = prune_changes(supabase)
+    if pruned:
+        print(f"処理済みの変更履歴を削除: {pruned}件", flush=True)
+    return stats
+
+
+def run_reconcile(supabase, index, embedder, cache, dry_run):
+    stats = reconcile(supabase, index, embedder, cache=cache, dry_run=dry_run)
+    prefix = "[dry-run] " if dry_run else ""
+    print(f"{prefix}突き合わせ: シーン {stats['scenes']}件 / 孤立ベクトル {stats['orphans']}件（うち旧ID {stats['legacy']}件）/ 未索引 {stats['missing']}件", flush=True)
+    return stats
+
+
+def run_once(supabase, index, embedder, cache, batch_size, check_target=None):
+    started = time.perf_counter()
+    stats = sync_dirty_records(
+        supabase, index, embedder, batch_size=batch_size, cache=cache, check_target=check_target,
+        on_batch=lambda s: print(f"{s['records']}件同期済み（{s['batches']}バッチ）", flush=True)
+    )
+    print(
+        f"同期完了: {stats['records']}件 / {stats['batches']}バッチ / {time.perf_counter() - started:.1f}s"
+        f" / 埋め込み p50 {stats['embed_p50']:.2f}s p99 {stats['embed_p99']:.2f}s"
+        f" / 書き込み p50 {stats['write_p50']:.2f}s p99 {stats['write_p99']:.2f}s",
+        flush=True
+    )
+    return stats
+
+
+def write_prometheus(path):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        f.write(metrics.to_prometheus())
+    os.replace(tmp, path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pinecone同期ワーカー")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--once", action="store_true", help="同期対象を1回処理して終了（既定）")
+    group.add_argument("--watch", action="store_true", help="一定間隔で同期対象をポーリングし続ける")
+    group.add_argument("--dry-run", action="store_true", help="件数と推定トークン数だけ表示する")
+    parser.add_argument("--reconcile", action="store_true", help="Supabaseとベクトルストアを突き合わせてずれを修復する（--dry-run と併用可）")
+    parser.add_argument("--source", choices=["changes", "flags"], default="changes",
+                        help="changes: scenario_plot_changes を順に処理する（既定）/ flags: needs_indexing だけを走査する（変更履歴を使えないとき）")
+    parser.add_argument("--interval", type=float, default=WATCH_INTERVAL_SECONDS, help="--watch のポーリング間隔（秒）")
+    parser.add_argument("--batch-size", type=int, default=SYNC_BATCH_SIZE)
+    parser.add_argument("--prometheus", help="実行ごとにメトリクスをPrometheusのテキスト形式で書き出すパス")
+    parser.add_argument("--log-json", action="store_true", help="同期結果をJSONの構造化ログとして出力する")
+    args = parser.parse_args(argv)
+    if args.log_json:
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    settings = load_settings()
+    supabase, client, index, target = create_clients(settings)
+
+    if args.dry_run:
+        if args.reconcile:
+            run_reconcile(supabase, index, None, None, True)
+        else:
+            dry_run(supabase, args.batch_size)
+        return 0
+
+    if not acquire_lock():
+        print("別のワーカーが実行中です。", file=sys.stderr)
+        return 1
+    try:
+        cache = EmbeddingCache()
+        embedder = CachedEmbedder(BatchEmbedder(client, model=target["model"]), cache)
+        indexed = cache.for_target(target)
+        run = run_changes if args.source == "changes" else run_once
+        if args.reconcile:
+            run_reconcile(supabase, index, embedder, indexed, False)
+            return 0
+        if not args.watch:
+            try:
+                run(supabase, index, embedder, indexed, args.batch_size, target_guard(supabase, target, settings["PINECONE_INDEX_NAME"]))
+            except TargetChangedError as e:
+                print(f"{e}。続きは次回の同期で新しい書き込み先に反映します。", flush=True)
+            if args.prometheus:
+                write_prometheus(args.prometheus)
+            return 0
+        while True:
+            try:
+                latest = load_active_target(supabase, settings["PINECONE_INDEX_NAME"])
+                if latest != target:
+                    target = latest
+                    index = create_target_index(settings, target)
+                    embedder = CachedEmbedder(BatchEmbedder(client, model=target["model"]), cache)
+                    indexed = cache.for_target(target)
+                    print(f"書き込み先が切り替わりました: {target_label(target)}", flush=True)
+                run(supabase, index, embedder, indexed, args.batch_size, target_guard(supabase, target, settings["PINECONE_INDEX_NAME"]))
+            except TargetChangedError as e:
+                print(f"{e}。次の周回から新しい書き込み先に反映します。", flush=True)
+            except Exception as e:
+                print(f"同期中にエラーが発生しました: {e}", file=sys.stderr, flush=True)
+            if args.prometheus:
+                write_prometheus(args.prometheus)
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        release_lock()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+SAMPLE_LIMIT = 1000
+PROMETHEUS_PREFIX = "webkun"
+QUANTILES = (0.5, 0.9, 0.99)
+
+logger = logging.getLogger("webkun.metrics")
+
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+# --- プロセス全体の集計 ---
+# タイマーは件数・合計と直近 SAMPLE_LIMIT 件のサンプル、カウンターは合計だけ持つ
+class Registry:
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds):
+        with self._lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = {"count": 0, "sum": 0.0, "samples": deque(maxlen=SAMPLE_LIMIT)}
+            timer["count"] += 1
+            timer["sum"] += seconds
+            timer["samples"].append(seconds)
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        with self._lock:
+            timers = {name: (t["count"], t["sum"], list(t["samples"])) for name, t in self.timers.items()}
+            counters = dict(self.counters)
+        return {
+            "timers": {
+                name: dict(count=count, sum=total, **{f"p{int(q * 100)}": percentile(samples, q) for q in QUANTILES})
+                for name, (count, total, samples) in sorted(timers.items())
+            },
+            "counters": dict(sorted(counters.items()))
+        }
+
+
+registry = Registry()
+
+# --- 1回のrerun（スクリプト実行）ごとの記録 ---
+# Streamlitはセッションごとに別スレッドでスクリプトを実行するので、スレッドローカルに持つ
+_rerun = threading.local()
+
+
+def start_rerun():
+    _rerun.started = time.perf_counter()
+    _rerun.timings = []
+    _rerun.counters = {}
+
+
+def rerun_timings():
+    return list(getattr(_rerun, "timings", []))
+
+
+def rerun_counters():
+    return dict(getattr(_rerun, "counters", {}))
+
+
+def rerun_elapsed():
+    started = getattr(_rerun, "started", None)
+    return time.perf_counter() - started if started is not None else 0.0
+
+
+@contextmanager
+def timer(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        registry.observe(name, elapsed)
+        timings = getattr(_rerun, "timings", None)
+        if timings is not None:
+            timings.append((name, elapsed))
+
+
+# rerun開始からの経過時間をタイマーとして記録する（初回描画までの時間など）
+def mark(name):
+    elapsed = rerun_elapsed()
+    registry.observe(name, elapsed)
+    timings = getattr(_rerun, "timings", None)
+    if timings is not None:
+        timings.append((name, elapsed))
+
+
+def count(name, value=1):
+    registry.increment(name, value)
+    counters = getattr(_rerun, "counters", None)
+    if counters is not None:
+        counters[name] = counters.get(name, 0) + value
+
+
+# --- 出力 ---
+def _label(name):
+    return name.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def to_prometheus():
+    summary = registry.summary()
+    lines = [f"# TYPE {PROMETHEUS_PREFIX}_duration_seconds summary"]
+    for name, t in summary["timers"].items():
+        label = f'name="{_label(name)}"'
+        for q in QUANTILES:
+            lines.append(f'{PROMETHEUS_PREFIX}_duration_seconds{{{label},quantile="{q}"}} {t[f"p{int(q * 100)}"]:.6f}')
+        lines.append(f"{PROMETHEUS_PREFIX}_duration_seconds_sum{{{label}}} {t['sum']:.6f}")
+        lines.append(f"{PROMETHEUS_PREFIX}_duration_seconds_count{{{label}}} {t['count']}")
+    lines.append(f"# TYPE {PROMETHEUS_PREFIX}_events_total counter")
+    for name, value in summary["counters"].items():
+        lines.append(f'{PROMETHEUS_PREFIX}_events_total{{name="{_label(name)}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+def log_json(event, **fields):
+    logger.info(json.dumps(dict(event=event, **fields), ensure_ascii=False))
+
+
+def log_rerun(**fields):
+    log_json(
+        "rerun",
+        elapsed=rerun_elapsed(),
+        timings=[{"name": name, "seconds": seconds} for name, seconds in rerun_timings()],
+        counters=rerun_counters(),
+        **fields
+    )
@@ -0,0 +1,218 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from data_access import iter_pages
+from chunking import build_chunk_id, split_plot
+from embedding_cache import cache_key
+
+SYNC_COLUMNS = "id, chapter_index, chapter_title, scene_index, plot_text, location, mood, related_characters, related_context_ids, version"
+SYNC_BATCH_SIZE = 100
+PINECONE_WORKERS = 8
+# これ以下ならメタデータだけの update を送る（超えたら埋め込みキャッシュのベクトルで upsert）
+METADATA_UPDATE_MAX_CHUNKS = 8
+
+
+def build_chunk_text(plot_text, location, mood):
+    return f"{plot_text}\n場所: {location}\n雰囲気: {mood}"
+
+
+def build_context_id(chapter_index, scene_index):
+    return f"plot-ch{chapter_index}-{scene_index}"
+
+
+def build_metadata(record, chunk, chunk_index=0, chunk_count=1):
+    return {
+        "context_id": build_context_id(record["chapter_index"], record["scene_index"]),
+        "chapter_index": record["chapter_index"],
+        "scene_index": record["scene_index"],
+        "chunk": chunk,
+        "chunk_type": "plot_text",
+        "chunk_index": chunk_index,
+        "chunk_count": chunk_count,
+        "chapter_title": record["chapter_title"],
+        "related_characters": record["related_characters"],
+        "related_context_ids": record["related_context_ids"]
+    }
+
+
+# --- シーン → チャンク ---
+# ベクトルIDは "plot-ch{章}-{シーン}#{チャンク番号}"、metadata の context_id でシーン単位にまとめ直せる
+def build_chunks(record):
+    context_id = build_context_id(record["chapter_index"], record["scene_index"])
+    parts = split_plot(record["plot_text"] or "")
+    chunks = []
+    for i, part in enumerate(parts):
+        text = build_chunk_text(part, record["location"], record["mood"])
+        chunks.append({
+            "id": build_chunk_id(context_id, i),
+            "text": text,
+            "metadata": build_metadata(record, text, i, len(parts))
+        })
+    return chunks
+
+
+# --- 同期対象の読み出し（idのキーセットでページング） ---
+def iter_dirty_pages(supabase, page_size=SYNC_BATCH_SIZE):
+    return iter_pages(supabase, SYNC_COLUMNS, page_size, eq={"needs_indexing": True}, timer="supabase.dirty_page")
+
+
+def embed_chunks(chunks, embedder):
+    with metrics.timer("sync.embed_batch"):
+        vectors = embedder.embed([c["text"] for c in chunks])
+    return [{"id": c["id"], "values": v, "metadata": c["metadata"]} for c, v in zip(chunks, vectors)]
+
+
+# --- 古いチャンクの削除 ---
+# シーンが短くなってチャンク数が減った場合や、チャンク分割前の "#" なしIDを消す
+# 書き込み先の indexed（cache）に記録があるシーンは、記録済みのチャンクIDから消すものを決める
+# 記録が無いシーン（この読み書き先に初めて書く・キャッシュを消した）だけ Pinecone の list で確かめる
+# cache_complete=True は空の名前空間への再埋め込み用で、記録が無いシーンにはベクトルも無いものとみなす
+def delete_stale_chunks(index, chunks_by_context, cache=None, cache_complete=False):
+    known = cache.indexed_ids(chunks_by_context) if cache is not None else {}
+    stale = [vid for context_id, ids in known.items() for vid in ids if vid not in chunks_by_context[context_id]]
+    unknown = [] if cache_complete else [item for item in chunks_by_context.items() if item[0] not in known]
+
+    def listed_stale_ids(item):
+        context_id, keep = item
+        with metrics.timer("pinecone.list"):
+            existing = [vid for page in index.list(prefix=f"{context_id}#") for vid in page]
+        return [context_id] + [vid for vid in existing if vid not in keep]
+
+    if unknown:
+        with ThreadPoolExecutor(max_workers=PINECONE_WORKERS) as pool:
+            stale += [vid for ids in pool.map(listed_stale_ids, unknown) for vid in ids]
+    if stale:
+        with metrics.timer("pinecone.delete"):
+            index.delete(ids=stale)
+    return stale
+
+
+# --- 埋め込みキャッシュを使った差分反映 ---
+# 同じベクトルIDに同じ本文が既に入っているチャンクは埋め込みAPIを呼ばない（少数ならメタデータだけ更新する）
+def split_metadata_only(chunks, cache, model):
+    keys = [cache_key(c["text"], model) for c in chunks]
+    indexed = cache.indexed_keys([c["id"] for c in chunks])
+    metadata_only = []
+    full = []
+    for chunk, key in zip(chunks, keys):
+        if indexed.get(chunk["id"]) == key:
+            metadata_only.append(chunk)
+        else:
+            full.append(chunk)
+    return metadata_only, full, [(c["id"], k) for c, k in zip(chunks, keys)]
+
+
+def _upsert(index, vectors):
+    with metrics.timer("pinecone.upsert"):
+        index.upsert(vectors=vectors)
+    metrics.count("pinecone.upserted_vectors", len(vectors))
+
+
+def _update_metadata(index, chunk):
+    with metrics.timer("pinecone.update_metadata"):
+        index.update(id=chunk["id"], set_metadata=chunk["metadata"])
+
+
+# --- 1バッチの同期（埋め込み → 書き込み） ---
+# 埋め込みまでを prepare_batch、Pineconeへの書き込みとフラグ解除を write_batch に分け、
+# ストリーミング同期では次のバッチの埋め込みと前のバッチの書き込みを重ねる
+# cache は書き込み先に絞った indexed（EmbeddingCache.for_target）を渡す
+def prepare_batch(embedder, records, cache=None):
+    chunks = [c for r in records for c in build_chunks(r)]
+    batch = {"records": records, "chunks": chunks, "vectors": [], "metadata_only": [], "indexed_pairs": None}
+    started = time.perf_counter()
+    if cache is None:
+        batch["vectors"] = embed_chunks(chunks, embedder)
+    else:
+        metadata_only, full, batch["indexed_pairs"] = split_metadata_only(chunks, cache, embedder.model)
+        metrics.count("sync.metadata_only_chunks", len(metadata_only))
+        # update は1件ずつの呼び出しになるので、件数が多いときはキャッシュ済みのベクトルを付けてまとめて upsert する
+        if len(metadata_only) > METADATA_UPDATE_MAX_CHUNKS:
+            full += metadata_only
+            metadata_only = []
+        batch["metadata_only"] = metadata_only
+        if full:
+            batch["vectors"] = embed_chunks(full, embedder)
+    batch["embed_seconds"] = time.perf_counter() - started
+    return batch
+
+
+# timings を渡すと、埋め込みとPinecone書き込みにかかった時間をバッチごとに追記する
+# clear_flags=False は稼働中でない書き込み先への再埋め込み用（needs_indexing は稼働中の同期に残しておく）
+# check_target（vector_target.target_guard）を渡すと、書き込みとフラグ解除の前に読み書き先が変わっていないか確かめる
+def write_batch(supabase, index, batch, cache=None, timings=None, clear_flags=True, cache_complete=False, check_target=None):
+    started = time.perf_counter()
+    if check_target:
+        check_target()
+    if batch["vectors"]:
+        _upsert(index, batch["vectors"])
+    if batch["metadata_only"]:
+        with ThreadPoolExecutor(max_workers=PINECONE_WORKERS) as pool:
+            list(pool.map(lambda c: _update_metadata(index, c), batch["metadata_only"]))
+    chunks_by_context = {}
+    for chunk in batch["chunks"]:
+        chunks_by_context.setdefault(chunk["metadata"]["context_id"], set()).add(chunk["id"])
+    stale = delete_stale_chunks(index, chunks_by_context, cache, cache_complete)
+    if cache is not None:
+        cache.forget_indexed(stale)
+        cache.mark_indexed(batch["indexed_pairs"])
+    if timings is not None:
+        timings["embed"].append(batch["embed_seconds"])
+        timings["write"].append(time.perf_counter() - started)
+    if clear_flags:
+        if check_target:
+            check_target()
+        clear_indexed_flags(supabase, batch["records"])
+
+
+def sync_batch(supabase, index, embedder, records, cache=None, timings=None, clear_flags=True, cache_complete=False, check_target=None):
+    write_batch(supabase, index, prepare_batch(embedder, records, cache), cache, timings, clear_flags, cache_complete, check_target)
+
+
+# --- フラグ解除 ---
+# 読み込んだ時点から version が変わっていない行だけ解除する。埋め込み中に編集された行はフラグが残り、次の同期で拾われる
+def clear_indexed_flags(supabase, records):
+    ids_by_version = {}
+    for r in records:
+        ids_by_version.setdefault(r.get("version"), []).append(r["id"])
+    with metrics.timer("supabase.clear_flags"):
+        for version, ids in ids_by_version.items():
+            query = supabase.table("scenario_plots").update({"needs_indexing": False}).in_("id", ids)
+            if version is not None:
+                query = query.eq("version", version)
+            query.execute()
+
+
+# --- ストリーミング同期 ---
+# バッチごとに upsert とフラグ解除を完結させるので、途中で失敗しても失われるのは書き込み中の1バッチ分だけ
+# 書き込みは1本の別スレッドで行い、その間に次のページを読んで埋め込む（メモリに持つのは最大2バッチ）
+# 読み書き先が切り替わったら、そのバッチで TargetChangedError を送出して止まる（残りのフラグは次の同期で拾われる）
+def sync_dirty_records(supabase, index, embedder, batch_size=SYNC_BATCH_SIZE, on_batch=None, cache=None, check_target=None):
+    stats = {"records": 0, "batches": 0}
+    timings = {"embed": [], "write": []}
+    started = time.perf_counter()
+
+    def finish(pending):
+        records = pending[0]
+        pending[1].result()
+        stats["records"] += len(records)
+        stats["batches"] += 1
+        if on_batch:
+            on_batch(stats)
+
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        pending = None
+        for page in iter_dirty_pages(supabase, batch_size):
+            batch = prepare_batch(embedder, page, cache)
+            if pending:
+                finish(pending)
+            pending = (page, writer.submit(write_batch, supabase, index, batch, cache, timings, check_target=check_target))
+        if pending:
+            finish(pending)
+    stats["seconds"] = time.perf_counter() - started
+    for name, samples in timings.items():
+        for q in metrics.QUANTILES:
+            stats[f"{name}_p{int(q * 100)}"] = metrics.percentile(samples, q)
+    metrics.log_json("sync", **stats)
+    return stats
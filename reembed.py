@@ -0,0 +1,255 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import metrics
+from data_access import CACHE_TTL_SECONDS, iter_pages
+from change_feed import VECTOR_ID_PREFIX, apply_changes, delete_watermark, save_watermark
+from embedding import BatchEmbedder, EMBEDDING_MODEL, ThrottledEmbedder, TokenBudget
+from embedding_cache import CachedEmbedder, EmbeddingCache
+from indexer import WATCH_INTERVAL_SECONDS, acquire_lock, create_clients, create_target_index, load_settings, release_lock
+from pinecone_sync import SYNC_BATCH_SIZE, SYNC_COLUMNS, sync_batch
+from vector_target import clear_left_seq, load_left_seq, save_active_target, save_left_seq, target_label
+
+REEMBED_CHECKPOINT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".reembed_checkpoint.json")
+REEMBED_LOCK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".reembed.lock")
+# 変更履歴の読み位置を indexer_state にも出しておき、ジョブ中に追いかける変更が削除されないようにする
+REEMBED_STATE = "reembed"
+REEMBED_TOKENS_PER_MINUTE = 1000000
+# 切り替え後も、キャッシュした読み書き先を使う画面や実行中の同期1周分は旧インデックスに書き込むことがある
+# それが止まるまで待ってから、もう一度変更履歴を追いかける
+SWITCH_GRACE_SECONDS = CACHE_TTL_SECONDS + 2 * WATCH_INTERVAL_SECONDS
+
+
+class CheckpointMismatchError(Exception):
+    pass
+
+
+# --- チェックポイント ---
+# 一時ファイルに書いてから置き換えるので、書き込み中に落ちても前回の内容が残る
+def load_checkpoint(path=REEMBED_CHECKPOINT_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_checkpoint(checkpoint, path=REEMBED_CHECKPOINT_PATH):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(checkpoint, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+# 件数だけをDB側で数える（行は1件しか返さない）
+def count_scenes(supabase):
+    with metrics.timer("supabase.count_scenes"):
+        return supabase.table("scenario_plots").select("id", count="exact").limit(1).execute().count or 0
+
+
+def latest_change_seq(supabase):
+    rows = supabase.table("scenario_plot_changes").select("seq").order("seq", desc=True).limit(1).execute().data
+    return rows[0]["seq"] if rows else 0
+
+
+# 全件走査を始める前の変更履歴の位置を覚えておき、走査中に入った変更はあとから追いかける
+# since_seq を渡すと全件走査を省き、その位置からの変更だけを追いかける（切り戻し用）
+# start_seq は切り替えたときに旧読み書き先の切り戻しの起点として残す
+def new_checkpoint(supabase, target, since_seq=None):
+    start_seq = latest_change_seq(supabase)
+    return {
+        "target": target,
+        "phase": "backfill" if since_seq is None else "catch_up",
+        "last_id": None,
+        "last_seq": start_seq if since_seq is None else since_seq,
+        "start_seq": start_seq,
+        "done": 0,
+        "total": count_scenes(supabase) if since_seq is None else 0,
+        "started_at": time.time()
+    }
+
+
+# --- 進捗と残り時間 ---
+def progress(checkpoint, done_this_run, elapsed):
+    rate = done_this_run / elapsed if elapsed > 0 else 0.0
+    remaining = max(checkpoint["total"] - checkpoint["done"], 0)
+    return {
+        "done": checkpoint["done"],
+        "total": checkpoint["total"],
+        "rate": rate,
+        "eta_seconds": remaining / rate if rate else None
+    }
+
+
+def format_eta(seconds):
+    if seconds is None:
+        return "不明"
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+# --- 全件の再埋め込み（idのキーセットでページング、バッチごとにチェックポイント） ---
+# 書き込み先は稼働中でないので needs_indexing は触らない
+def backfill(supabase, index, embedder, checkpoint, path=REEMBED_CHECKPOINT_PATH, batch_size=SYNC_BATCH_SIZE, on_progress=None, cache=None):
+    started = time.perf_counter()
+    done_at_start = checkpoint["done"]
+    for page in iter_pages(supabase, SYNC_COLUMNS, batch_size, after=checkpoint["last_id"], timer="supabase.reembed_page"):
+        sync_batch(supabase, index, embedder, page, cache, clear_flags=False, cache_complete=checkpoint.get("fresh", False))
+        # 書き込みが終わってから位置を進めるので、落ちても最後のバッチをやり直すだけで済む
+        checkpoint["last_id"] = page[-1]["id"]
+        checkpoint["done"] += len(page)
+        save_checkpoint(checkpoint, path)
+        if on_progress:
+            on_progress(progress(checkpoint, checkpoint["done"] - done_at_start, time.perf_counter() - started))
+    checkpoint["phase"] = "catch_up"
+    save_checkpoint(checkpoint, path)
+
+
+# --- 走査中に入った変更を移行先に反映 ---
+def catch_up(supabase, index, embedder, checkpoint, path=REEMBED_CHECKPOINT_PATH, batch_size=SYNC_BATCH_SIZE, cache=None):
+    applied = 0
+    while True:
+        with metrics.timer("supabase.change_page"):
+            changes = supabase.table("scenario_plot_changes").select("seq, scene_id, op, old_context_id, new_context_id").gt("seq", checkpoint["last_seq"]).order("seq").limit(batch_size).execute().data
+        if not changes:
+            break
+        apply_changes(supabase, index, embedder, changes, cache, clear_flags=False)
+        checkpoint["last_seq"] = changes[-1]["seq"]
+        save_checkpoint(checkpoint, path)
+        save_watermark(supabase, checkpoint["last_seq"], REEMBED_STATE)
+        applied += len(changes)
+        if len(changes) < batch_size:
+            break
+    return applied
+
+
+# --- 再埋め込みジョブ ---
+# backfill → catch_up → 読み書き先の切り替え → switched（切り替え直前に旧ワーカーが処理した変更を拾う）
+# → grace（旧読み書き先への書き込みが止まるまで待ってから、その間の変更を拾う）→ done
+# どの段階で止まっても、同じ移行先を指定して再実行すれば続きから進む
+# previous（切り替え前の読み書き先）を渡すと、切り戻しの起点を app_config に残す
+def run_job(supabase, index, embedder, target, path=REEMBED_CHECKPOINT_PATH, batch_size=SYNC_BATCH_SIZE,
+            switch=True, restart=False, on_progress=None, grace_seconds=SWITCH_GRACE_SECONDS, sleep=time.sleep, on_wait=None,
+            previous=None, since_seq=None):
+    checkpoint = None if restart else load_checkpoint(path)
+    if checkpoint and checkpoint["target"] != target and checkpoint["phase"] != "done":
+        raise CheckpointMismatchError(f"別の移行先のチェックポイントがあります: {target_label(checkpoint['target'])}（破棄するには --restart）")
+    if checkpoint is None or checkpoint["phase"] == "done":
+        checkpoint = new_checkpoint(supabase, target, since_seq)
+        # 空の名前空間なら、この後に書くシーン以外にベクトルは無いので、古いチャンクの確認（list）を省ける
+        checkpoint["fresh"] = since_seq is None and not next(iter(index.list(prefix=VECTOR_ID_PREFIX)), None)
+        save_checkpoint(checkpoint, path)
+    save_watermark(supabase, checkpoint["last_seq"], REEMBED_STATE)
+    # 移行先に書いた内容を読み書き先ごとの indexed に残し、あとで切り戻したときの差分反映に使う
+    cache = embedder.cache.for_target(target) if hasattr(embedder, "cache") else None
+
+    if checkpoint["phase"] == "backfill":
+        backfill(supabase, index, embedder, checkpoint, path, batch_size, on_progress, cache)
+    if checkpoint["phase"] == "catch_up":
+        checkpoint["caught_up"] = checkpoint.get("caught_up", 0) + catch_up(supabase, index, embedder, checkpoint, path, batch_size, cache)
+        save_checkpoint(checkpoint, path)
+        if not switch:
+            return checkpoint
+        if previous:
+            save_left_seq(supabase, previous, checkpoint.get("start_seq", 0))
+        save_active_target(supabase, target)
+        clear_left_seq(supabase, target)
+        checkpoint["phase"] = "switched"
+        checkpoint["switched_at"] = time.time()
+        save_checkpoint(checkpoint, path)
+    if checkpoint["phase"] == "switched":
+        checkpoint["caught_up"] = checkpoint.get("caught_up", 0) + catch_up(supabase, index, embedder, checkpoint, path, batch_size, cache)
+        checkpoint["phase"] = "grace"
+        save_checkpoint(checkpoint, path)
+    if checkpoint["phase"] == "grace":
+        remaining = checkpoint["switched_at"] + grace_seconds - time.time()
+        if remaining > 0:
+            if on_wait:
+                on_wait(remaining)
+            sleep(remaining)
+        checkpoint["caught_up"] = checkpoint.get("caught_up", 0) + catch_up(supabase, index, embedder, checkpoint, path, batch_size, cache)
+        checkpoint["phase"] = "done"
+        checkpoint["finished_at"] = time.time()
+        save_checkpoint(checkpoint, path)
+        delete_watermark(supabase, REEMBED_STATE)
+    metrics.log_json("reembed", target=target_label(target), phase=checkpoint["phase"], done=checkpoint["done"], total=checkpoint["total"])
+    return checkpoint
+
+
+def print_progress(p):
+    percent = p["done"] / p["total"] * 100 if p["total"] else 100.0
+    print(f"{p['done']}/{p['total']}件（{percent:.1f}%）/ {p['rate']:.1f}件/s / 残り約 {format_eta(p['eta_seconds'])}", flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="埋め込みモデルやチャンク形式の変更に伴う全件の再埋め込み")
+    parser.add_argument("--index", help="移行先のインデックス名（既定は PINECONE_INDEX_NAME。次元が変わるモデルは事前に作成したインデックスを指定）")
+    parser.add_argument("--namespace", default="", help="移行先の名前空間")
+    parser.add_argument("--model", default=EMBEDDING_MODEL)
+    parser.add_argument("--tokens-per-minute", type=int, default=REEMBED_TOKENS_PER_MINUTE, help="埋め込みAPIに送るトークン数の上限（1分あたり）")
+    parser.add_argument("--batch-size", type=int, default=SYNC_BATCH_SIZE)
+    parser.add_argument("--checkpoint", default=REEMBED_CHECKPOINT_PATH)
+    parser.add_argument("--grace-seconds", type=float, default=SWITCH_GRACE_SECONDS, help="切り替え後、旧読み書き先への書き込みが止まるまで待つ秒数")
+    parser.add_argument("--no-switch", action="store_true", help="再埋め込みだけ行い、読み書き先は切り替えない")
+    parser.add_argument("--restart", action="store_true", help="チェックポイントを破棄して最初からやり直す")
+    parser.add_argument("--status", action="store_true", help="現在の読み書き先とチェックポイントを表示する")
+    parser.add_argument("--activate", action="store_true", help="再埋め込みせず、使われなくなってからの変更だけを追いかけて読み書き先を戻す（切り戻し用）")
+    parser.add_argument("--since-seq", type=int, help="--activate で追いかける変更履歴の起点（既定は切り替えたときに記録した位置）")
+    args = parser.parse_args(argv)
+
+    settings = load_settings()
+    supabase, client, _, active = create_clients(settings)
+    target = {"index": args.index or settings["PINECONE_INDEX_NAME"], "namespace": args.namespace, "model": args.model}
+
+    if args.status:
+        print(f"現在の読み書き先: {target_label(active)}")
+        checkpoint = load_checkpoint(args.checkpoint)
+        if checkpoint:
+            print(f"チェックポイント: {target_label(checkpoint['target'])} / {checkpoint['phase']} / {checkpoint['done']}/{checkpoint['total']}件")
+        return 0
+    if target == active:
+        print(f"移行先が現在の読み書き先と同じです: {target_label(target)}", file=sys.stderr)
+        return 1
+    since_seq = None
+    if args.activate:
+        since_seq = args.since_seq if args.since_seq is not None else load_left_seq(supabase, target)
+        if since_seq is None:
+            print(f"{target_label(target)} が使われなくなった位置が記録されていません。--since-seq で変更履歴の起点を指定してください。", file=sys.stderr)
+            return 1
+
+    if not acquire_lock(REEMBED_LOCK_PATH):
+        print("別の再埋め込みジョブが実行中です。", file=sys.stderr)
+        return 1
+    try:
+        budget = TokenBudget(args.tokens_per_minute)
+        embedder = CachedEmbedder(ThrottledEmbedder(BatchEmbedder(client, model=target["model"]), budget), EmbeddingCache())
+        print(f"{'切り戻し' if args.activate else '再埋め込み'}: {target_label(active)} → {target_label(target)}", flush=True)
+        checkpoint = run_job(
+            supabase, create_target_index(settings, target), embedder, target, args.checkpoint, args.batch_size,
+            switch=not args.no_switch, restart=args.restart, on_progress=print_progress, grace_seconds=args.grace_seconds,
+            on_wait=lambda seconds: print(f"読み書き先を切り替えました。旧読み書き先への書き込みが止まるまで {format_eta(seconds)} 待ってから変更を追いかけます。", flush=True),
+            previous=active, since_seq=since_seq
+        )
+        print(
+            f"{checkpoint['phase']}: {checkpoint['done']}件 / 追従した変更 {checkpoint.get('caught_up', 0)}件"
+            f" / キャッシュ {embedder.hits}件 / API {embedder.embedder.tokens}トークン / 予算待ち {budget.waited:.0f}s",
+            flush=True
+        )
+        return 0
+    except CheckpointMismatchError as e:
+        print(e, file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        print("中断しました。同じ引数で再実行すると続きから再開します。", file=sys.stderr)
+        return 130
+    finally:
+        release_lock(REEMBED_LOCK_PATH)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
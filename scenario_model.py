@@ -0,0 +1,138 @@
+import sys
+
+MOOD_SEPARATOR = "/"
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def parse_moods(mood):
+    return tuple(_intern(m) for m in (mood or "").split(MOOD_SEPARATOR) if m)
+
+
+def join_moods(moods):
+    return MOOD_SEPARATOR.join(moods)
+
+
+# --- シーン ---
+# Supabaseの行（dict）の代わりに __slots__ のオブジェクトで持つ。章タイトル・雰囲気・キャラIDは intern して共有する
+# plot_text などは軽量インデックスから作った場合 None のまま（必要になったら load_scene で読む）
+class Scene:
+    __slots__ = ("id", "chapter_index", "chapter_title", "scene_index", "plot_text", "location",
+                 "moods", "related_characters", "related_context_ids", "version")
+
+    def __init__(self, id=None, chapter_index=0, chapter_title="", scene_index=0, plot_text=None, location=None,
+                 moods=(), related_characters=(), related_context_ids=(), version=1):
+        self.id = id
+        self.chapter_index = chapter_index
+        self.chapter_title = _intern(chapter_title)
+        self.scene_index = scene_index
+        self.plot_text = plot_text
+        self.location = _intern(location)
+        self.moods = tuple(moods)
+        self.related_characters = tuple(_intern(c) for c in related_characters)
+        self.related_context_ids = tuple(related_context_ids)
+        self.version = version
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(
+            id=row.get("id"),
+            chapter_index=row.get("chapter_index", 0),
+            chapter_title=row.get("chapter_title") or "",
+            scene_index=row.get("scene_index", 0),
+            plot_text=row.get("plot_text"),
+            location=row.get("location"),
+            moods=parse_moods(row.get("mood")),
+            related_characters=row.get("related_characters") or (),
+            related_context_ids=row.get("related_context_ids") or (),
+            version=row.get("version", 1)
+        )
+
+    # 保存用の行（id と version は書き込み方法によって扱いが違うので含めない）
+    def to_row(self, needs_indexing=True):
+        return {
+            "chapter_index": self.chapter_index,
+            "chapter_title": self.chapter_title,
+            "scene_index": self.scene_index,
+            "plot_text": self.plot_text or "",
+            "location": self.location or "",
+            "mood": self.mood,
+            "related_characters": list(self.related_characters),
+            "related_context_ids": list(self.related_context_ids),
+            "needs_indexing": needs_indexing
+        }
+
+    @property
+    def mood(self):
+        return join_moods(self.moods)
+
+    @property
+    def label(self):
+        return f"{self.chapter_title} - {self.scene_index}"
+
+
+class Character:
+    __slots__ = ("id", "name")
+
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+
+class CharacterIndex:
+    def __init__(self, rows):
+        self.characters = [Character(r["id"], r["name"]) for r in rows]
+        self.by_name = {c.name: c.id for c in self.characters}
+        self.by_id = {c.id: c.name for c in self.characters}
+
+    # 画面で使っている char_dict（名前 → UUID）と同じもの
+    @property
+    def char_dict(self):
+        return self.by_name
+
+    def names(self, ids):
+        return [self.by_id.get(i, i) for i in ids]
+
+
+# --- シナリオ全体 ---
+# 章・シーン番号・キャラ・雰囲気ごとの索引をまとめて1回だけ作る
+class Scenario:
+    def __init__(self, scenes):
+        self.scenes = sorted(scenes, key=lambda s: (s.chapter_index, s.scene_index))
+        self.by_id = {}
+        self.by_key = {}
+        self.by_chapter = {}
+        self.by_character = {}
+        self.by_mood = {}
+        self.chapter_title_map = {}
+        for scene in self.scenes:
+            self.by_id[scene.id] = scene
+            self.by_key[(scene.chapter_index, scene.scene_index)] = scene
+            self.by_chapter.setdefault(scene.chapter_index, []).append(scene)
+            if scene.chapter_title:
+                self.chapter_title_map[scene.chapter_title] = scene.chapter_index
+            for char_id in scene.related_characters:
+                self.by_character.setdefault(char_id, []).append(scene)
+            for mood in scene.moods:
+                self.by_mood.setdefault(mood, []).append(scene)
+
+    @classmethod
+    def from_rows(cls, rows):
+        return cls([Scene.from_row(r) for r in rows])
+
+    def __len__(self):
+        return len(self.scenes)
+
+    @property
+    def chapter_titles(self):
+        return list(self.chapter_title_map.keys())
+
+    def next_scene_index(self, chapter_index):
+        scenes = self.by_chapter.get(chapter_index)
+        return scenes[-1].scene_index + 1 if scenes else 0
+
+    def record_options(self, chapter_index=None):
+        scenes = self.scenes if chapter_index is None else self.by_chapter.get(chapter_index, [])
+        return {s.label: s.id for s in scenes}
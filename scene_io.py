@@ -0,0 +1,231 @@
+import argparse
+import csv
+import json
+import sys
+import uuid
+
+from data_access import SCENARIO_PLOT_COLUMNS, iter_pages, load_character_index
+from pinecone_sync import sync_batch
+from scenario_model import join_moods
+from vector_target import TargetChangedError, target_guard
+
+IMPORT_BATCH_SIZE = 500
+EXPORT_PAGE_SIZE = 1000
+
+EXPORT_FIELDS = [c.strip() for c in SCENARIO_PLOT_COLUMNS.split(",")]
+REQUIRED_FIELDS = ["chapter_index", "scene_index", "plot_text"]
+LIST_FIELDS = ["related_characters", "related_context_ids"]
+
+
+class RowError(ValueError):
+    pass
+
+
+# --- 読み込み（1行ずつ） ---
+def iter_rows(f, fmt):
+    if fmt == "jsonl":
+        for line_no, line in enumerate(f, start=1):
+            if line.strip():
+                try:
+                    yield line_no, json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield line_no, RowError(f"JSONとして読めません: {e}")
+    else:
+        for line_no, row in enumerate(csv.DictReader(f), start=2):
+            yield line_no, row
+
+
+def _split_list(value):
+    if value is None or value == "":
+        return []
+    if isinstance(value, list):
+        return [str(v).strip() for v in value if str(v).strip()]
+    return [s.strip() for s in str(value).split(",") if s.strip()]
+
+
+def _is_uuid(value):
+    try:
+        uuid.UUID(value)
+        return True
+    except ValueError:
+        return False
+
+
+# --- 1行を scenario_plots のレコードに変換 ---
+# 登場キャラは画面と同じく char_dict で名前→UUIDに変換し、UUIDはそのまま通す
+def to_record(row, char_dict):
+    # JSONLでは 5 や null のように、JSONとしては読めてもオブジェクトでない行がある
+    if not isinstance(row, dict):
+        raise RowError("1行に1つのJSONオブジェクトを書いてください")
+    unknown = [k for k in row if k not in EXPORT_FIELDS]
+    if unknown:
+        raise RowError(f"不明な列: {', '.join(map(str, unknown))}")
+    missing = [k for k in REQUIRED_FIELDS if row.get(k) in (None, "")]
+    if missing:
+        raise RowError(f"必須列が空です: {', '.join(missing)}")
+    try:
+        record = {
+            "chapter_index": int(row["chapter_index"]),
+            "scene_index": int(row["scene_index"]),
+        }
+    except (TypeError, ValueError):
+        raise RowError("chapter_index / scene_index は整数で指定してください")
+    record["chapter_title"] = row.get("chapter_title") or ""
+    record["plot_text"] = str(row["plot_text"])
+    record["location"] = row.get("location") or ""
+    mood = row.get("mood") or ""
+    record["mood"] = join_moods(str(m) for m in mood) if isinstance(mood, list) else str(mood)
+
+    characters = []
+    for name in _split_list(row.get("related_characters")):
+        if name in char_dict:
+            characters.append(char_dict[name])
+        elif _is_uuid(name):
+            characters.append(name)
+        else:
+            raise RowError(f"キャラが見つかりません: {name}")
+    record["related_characters"] = characters
+    record["related_context_ids"] = _split_list(row.get("related_context_ids"))
+    if row.get("id"):
+        record["id"] = row["id"]
+    record["needs_indexing"] = True
+    return record
+
+
+def write_error_message(e):
+    if getattr(e, "code", None) == "23505":
+        return "同じ章・シーン番号のシーンが既にあります"
+    return getattr(e, "message", None) or str(e)
+
+
+def _write_batch(supabase, batch):
+    with_id = [r for r in batch if "id" in r]
+    without_id = [r for r in batch if "id" not in r]
+    written = []
+    if with_id:
+        written += supabase.table("scenario_plots").upsert(with_id).execute().data
+    if without_id:
+        written += supabase.table("scenario_plots").insert(without_id).execute().data
+    return written
+
+
+# --- 一括インポート ---
+# index と embedder を渡すと、書き込んだバッチをそのままPineconeにも反映する
+# 途中で読み書き先が切り替わったら（check_target）反映だけをやめて取り込みは続ける。反映していない行は needs_indexing のまま残る
+def import_scenes(supabase, f, fmt, char_dict, batch_size=IMPORT_BATCH_SIZE, index=None, embedder=None, cache=None, on_batch=None, check_target=None):
+    stats = {"imported": 0, "indexed": 0, "batches": 0, "errors": [], "target_changed": False}
+
+    # 書き込みは1文ごとに全件成功か全件失敗なので、バッチが失敗したら1行ずつ書き直し（upsert 済みの行は同じ内容で上書きされるだけ）、
+    # 書けなかった行だけ行番号付きで報告する
+    def flush(batch):
+        try:
+            written = _write_batch(supabase, [record for _, record in batch])
+        except Exception:
+            written = []
+            for line_no, record in batch:
+                try:
+                    written += _write_batch(supabase, [record])
+                except Exception as e:
+                    stats["errors"].append((line_no, write_error_message(e)))
+        stats["imported"] += len(written)
+        stats["batches"] += 1
+        if index is not None and written and not stats["target_changed"]:
+            try:
+                sync_batch(supabase, index, embedder, written, cache, check_target=check_target)
+                stats["indexed"] += len(written)
+            except TargetChangedError:
+                stats["target_changed"] = True
+        if on_batch:
+            on_batch(stats)
+
+    batch = []
+    for line_no, row in iter_rows(f, fmt):
+        try:
+            if isinstance(row, RowError):
+                raise row
+            batch.append((line_no, to_record(row, char_dict)))
+        except RowError as e:
+            stats["errors"].append((line_no, str(e)))
+            continue
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+    stats["errors"].sort()
+    return stats
+
+
+# --- 一括エクスポート（idのキーセットでページング） ---
+def iter_all_scenes(supabase, page_size=EXPORT_PAGE_SIZE):
+    for page in iter_pages(supabase, SCENARIO_PLOT_COLUMNS, page_size, timer="supabase.export_page"):
+        yield from page
+
+
+def export_scenes(supabase, f, fmt):
+    count = 0
+    if fmt == "jsonl":
+        for scene in iter_all_scenes(supabase):
+            f.write(json.dumps(scene, ensure_ascii=False) + "\n")
+            count += 1
+    else:
+        writer = csv.DictWriter(f, fieldnames=EXPORT_FIELDS)
+        writer.writeheader()
+        for scene in iter_all_scenes(supabase):
+            row = dict(scene)
+            for field in LIST_FIELDS:
+                row[field] = ",".join(row.get(field) or [])
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def detect_format(filename):
+    return "csv" if filename.lower().endswith(".csv") else "jsonl"
+
+
+def main(argv=None):
+    from embedding import BatchEmbedder
+    from embedding_cache import CachedEmbedder, EmbeddingCache
+    from indexer import create_clients, load_settings
+
+    parser = argparse.ArgumentParser(description="シーンの一括インポート/エクスポート")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_import = sub.add_parser("import", help="JSONL/CSVからシーンを取り込む")
+    p_import.add_argument("path")
+    p_import.add_argument("--index", action="store_true", help="取り込みと同時にPineconeへ反映する")
+    p_import.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    p_export = sub.add_parser("export", help="全シーンをJSONL/CSVに書き出す")
+    p_export.add_argument("path")
+    args = parser.parse_args(argv)
+
+    settings = load_settings()
+    supabase, client, index, target = create_clients(settings)
+    fmt = detect_format(args.path)
+
+    if args.command == "export":
+        with open(args.path, "w", encoding="utf-8", newline="") as f:
+            count = export_scenes(supabase, f, fmt)
+        print(f"{count}件を書き出しました: {args.path}")
+        return 0
+
+    char_dict = load_character_index(supabase).char_dict
+    cache = EmbeddingCache() if args.index else None
+    embedder = CachedEmbedder(BatchEmbedder(client, model=target["model"]), cache) if args.index else None
+    with open(args.path, encoding="utf-8-sig", newline="") as f:
+        stats = import_scenes(
+            supabase, f, fmt, char_dict, batch_size=args.batch_size,
+            index=index if args.index else None, embedder=embedder, cache=cache.for_target(target) if args.index else None,
+            on_batch=lambda s: print(f"{s['imported']}件取り込み済み", flush=True),
+            check_target=target_guard(supabase, target, settings["PINECONE_INDEX_NAME"])
+        )
+    for line_no, message in stats["errors"]:
+        print(f"{line_no}行目: {message}", file=sys.stderr)
+    if stats["target_changed"]:
+        print("取り込み中に書き込み先が切り替わったため、残りの行は次回の同期で新しい書き込み先に反映します。")
+    print(f"取り込み {stats['imported']}件 / 索引 {stats['indexed']}件 / エラー {len(stats['errors'])}件")
+    return 1 if stats["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,56 @@
+-- 修正モードの楽観的排他制御とシーン番号の採番
+
+-- レコードごとのバージョン。画面からの更新は version = 読み込んだ値 を条件に付ける
+alter table scenario_plots add column if not exists version integer not null default 1;
+
+-- 内容が変わる更新では、どの経路（画面・インポートの upsert・SQL）でも version を +1 する
+-- needs_indexing だけの更新では上げない（同期済みフラグの解除で編集中の version がずれないように）
+-- クライアントが version を指定しても無視する
+create or replace function bump_scenario_plot_version()
+returns trigger
+language plpgsql
+as $$
+begin
+    if (old.chapter_index, old.scene_index, old.chapter_title, old.plot_text, old.location, old.mood,
+        old.related_characters, old.related_context_ids)
+       is distinct from
+       (new.chapter_index, new.scene_index, new.chapter_title, new.plot_text, new.location, new.mood,
+        new.related_characters, new.related_context_ids) then
+        new.version := old.version + 1;
+    else
+        new.version := old.version;
+    end if;
+    return new;
+end;
+$$;
+
+drop trigger if exists scenario_plots_version_trigger on scenario_plots;
+create trigger scenario_plots_version_trigger
+before update on scenario_plots
+for each row execute function bump_scenario_plot_version();
+
+-- 同じ章で同じシーン番号が2件できないようにする
+-- （既存データに重複がある場合は先に番号を振り直してから実行する）
+create unique index if not exists scenario_plots_chapter_scene_key on scenario_plots (chapter_index, scene_index);
+
+-- 章ごとの次のシーン番号
+create table if not exists chapter_scene_counters (
+    chapter_index integer primary key,
+    next_scene_index integer not null
+);
+
+-- シーン番号を1つ確保して返す。行ロック付きの upsert なので同時に呼ばれても番号は重複しない
+-- 一括インポートなどで番号が先に進んでいても、既存の最大値より後ろから払い出す
+create or replace function allocate_scene_index(p_chapter_index integer)
+returns integer
+language sql
+as $$
+    insert into chapter_scene_counters as c (chapter_index, next_scene_index)
+    values (
+        p_chapter_index,
+        coalesce((select max(scene_index) from scenario_plots where chapter_index = p_chapter_index), -1) + 2
+    )
+    on conflict (chapter_index) do update
+        set next_scene_index = greatest(c.next_scene_index, excluded.next_scene_index - 1) + 1
+    returning next_scene_index - 1;
+$$;
@@ -0,0 +1,53 @@
+-- 差分インデックス用の変更履歴（アウトボックス）
+-- scenario_plots への追加・更新・削除をトリガーで記録し、indexer.py --source changes が seq 順に処理する
+
+create table if not exists scenario_plot_changes (
+    seq bigserial primary key,
+    scene_id text not null,
+    op text not null check (op in ('insert', 'update', 'delete')),
+    old_context_id text,
+    new_context_id text,
+    changed_at timestamptz not null default now()
+);
+
+-- 処理済みの位置（ワーカーごと）
+create table if not exists indexer_state (
+    name text primary key,
+    last_seq bigint not null default 0,
+    updated_at timestamptz not null default now()
+);
+
+create or replace function record_scenario_plot_change()
+returns trigger
+language plpgsql
+as $$
+begin
+    if tg_op = 'INSERT' then
+        insert into scenario_plot_changes (scene_id, op, new_context_id)
+        values (new.id::text, 'insert', 'plot-ch' || new.chapter_index || '-' || new.scene_index);
+        return new;
+    elsif tg_op = 'UPDATE' then
+        -- needs_indexing や version だけの更新はベクトルに影響しないので記録しない
+        if (old.chapter_index, old.scene_index, old.chapter_title, old.plot_text, old.location, old.mood,
+            old.related_characters, old.related_context_ids)
+           is distinct from
+           (new.chapter_index, new.scene_index, new.chapter_title, new.plot_text, new.location, new.mood,
+            new.related_characters, new.related_context_ids) then
+            insert into scenario_plot_changes (scene_id, op, old_context_id, new_context_id)
+            values (new.id::text, 'update',
+                    'plot-ch' || old.chapter_index || '-' || old.scene_index,
+                    'plot-ch' || new.chapter_index || '-' || new.scene_index);
+        end if;
+        return new;
+    else
+        insert into scenario_plot_changes (scene_id, op, old_context_id)
+        values (old.id::text, 'delete', 'plot-ch' || old.chapter_index || '-' || old.scene_index);
+        return old;
+    end if;
+end;
+$$;
+
+drop trigger if exists scenario_plot_changes_trigger on scenario_plots;
+create trigger scenario_plot_changes_trigger
+after insert or update or delete on scenario_plots
+for each row execute function record_scenario_plot_change();
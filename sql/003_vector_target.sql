@@ -0,0 +1,24 @@
+-- ベクトルの読み書き先（インデックス・名前空間・埋め込みモデル）
+-- reembed.py が移行先への再埋め込みを終えたあと、この1行を書き換えて読み手を一斉に切り替える
+-- 再埋め込み中に入った変更は scenario_plot_changes（002_scenario_plot_changes.sql）から拾うので、先に002を適用しておく
+
+create table if not exists app_config (
+    key text primary key,
+    value jsonb not null,
+    updated_at timestamptz not null default now()
+);
+
+create or replace function touch_app_config()
+returns trigger
+language plpgsql
+as $$
+begin
+    new.updated_at := now();
+    return new;
+end;
+$$;
+
+drop trigger if exists app_config_touch on app_config;
+create trigger app_config_touch
+before update on app_config
+for each row execute function touch_app_config();
@@ -0,0 +1,185 @@
+import threading
+
+import numpy as np
+
+import metrics
+from data_access import iter_pages
+from pinecone_sync import SYNC_COLUMNS, build_chunks
+
+SEARCH_TOP_K = 10
+# 1シーンが複数チャンクに分かれるので、多めに取ってからシーン単位にまとめる
+CHUNK_FANOUT = 4
+LOAD_PAGE_SIZE = 1000
+
+
+# --- チャンク単位の結果をシーン単位にまとめる（各シーンで最も近いチャンクを残す） ---
+def merge_by_scene(results, top_k):
+    merged = {}
+    for r in results:
+        context_id = r["metadata"]["context_id"]
+        if context_id not in merged or r["score"] > merged[context_id]["score"]:
+            merged[context_id] = dict(r, id=context_id, chunk_id=r["id"])
+    return sorted(merged.values(), key=lambda r: -r["score"])[:top_k]
+
+
+# --- ローカルベクトルインデックス（NumPy総当たり） ---
+# 正規化済みベクトルの行列積でコサイン類似度を一括計算する
+# matrix は行ごとに正規化済みの float32、scene_ids は行ごとのシーンID（差分更新で使う）
+class LocalVectorIndex:
+    def __init__(self, ids=(), matrix=None, metadata=(), scene_ids=()):
+        self.ids = list(ids)
+        self.metadata = list(metadata)
+        self.scene_ids = list(scene_ids)
+        self.matrix = matrix if matrix is not None else np.empty((0, 0), dtype=np.float32)
+        # フィルター用の列
+        self.chapter_index = np.asarray([m["chapter_index"] for m in self.metadata], dtype=np.int64)
+        self.chunk_type = np.asarray([m["chunk_type"] for m in self.metadata], dtype=object)
+        self.rows_by_character = {}
+        for row, m in enumerate(self.metadata):
+            for char_id in m.get("related_characters") or []:
+                self.rows_by_character.setdefault(char_id, []).append(row)
+
+    # keep が True の行だけを (ids, matrix, metadata, scene_ids) で返す
+    def part(self, keep):
+        rows = np.flatnonzero(keep)
+        return ([self.ids[i] for i in rows], self.matrix[rows], [self.metadata[i] for i in rows], [self.scene_ids[i] for i in rows])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _mask(self, chapter_indexes=None, characters=None, chunk_types=None):
+        mask = np.ones(len(self.ids), dtype=bool)
+        if chapter_indexes:
+            mask &= np.isin(self.chapter_index, list(chapter_indexes))
+        if chunk_types:
+            mask &= np.isin(self.chunk_type, list(chunk_types))
+        if characters:
+            char_mask = np.zeros(len(self.ids), dtype=bool)
+            for char_id in characters:
+                char_mask[self.rows_by_character.get(char_id, [])] = True
+            mask &= char_mask
+        return mask
+
+    def query(self, vector, top_k=SEARCH_TOP_K, chapter_indexes=None, characters=None, chunk_types=None):
+        if not self.ids:
+            return []
+        q = np.asarray(vector, dtype=np.float32)
+        q = q / (np.linalg.norm(q) or 1)
+        scores = self.matrix @ q
+        mask = self._mask(chapter_indexes, characters, chunk_types)
+        candidates = np.flatnonzero(mask)
+        if candidates.size == 0:
+            return []
+        limit = min(top_k * CHUNK_FANOUT, candidates.size)
+        picked = candidates[np.argpartition(-scores[candidates], limit - 1)[:limit]]
+        picked = picked[np.argsort(-scores[picked])]
+        return merge_by_scene([{"id": self.ids[i], "score": float(scores[i]), "metadata": self.metadata[i]} for i in picked], top_k)
+
+
+# --- Pineconeバックエンド（ローカルと同じ結果形式で返す） ---
+class PineconeSearchBackend:
+    def __init__(self, index):
+        self.index = index
+
+    def query(self, vector, top_k=SEARCH_TOP_K, chapter_indexes=None, characters=None, chunk_types=None):
+        conditions = {}
+        if chapter_indexes:
+            conditions["chapter_index"] = {"$in": list(chapter_indexes)}
+        if characters:
+            conditions["related_characters"] = {"$in": list(characters)}
+        if chunk_types:
+            conditions["chunk_type"] = {"$in": list(chunk_types)}
+        response = self.index.query(vector=list(vector), top_k=top_k * CHUNK_FANOUT, filter=conditions or None, include_metadata=True)
+        return merge_by_scene([{"id": m.id, "score": m.score, "metadata": m.metadata} for m in response.matches], top_k)
+
+
+# --- チャンク本文 → 正規化済みの float32 行列 ---
+# キャッシュ付きエンベッダーならキャッシュのバイト列をそのまま frombuffer し、Python の float リストを作らない
+def embed_matrix(texts, embedder):
+    with metrics.timer("sync.embed_batch"):
+        if hasattr(embedder, "embed_blobs"):
+            blobs = embedder.embed_blobs(texts)
+            matrix = np.frombuffer(b"".join(blobs), dtype=np.float32).reshape(len(blobs), -1)
+        else:
+            matrix = np.asarray(embedder.embed(texts), dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+# 1ページ分のシーンを (ids, matrix, metadata, scene_ids) にする
+def embed_page(records, embedder):
+    chunks = [(r["id"], c) for r in records for c in build_chunks(r)]
+    if not chunks:
+        return [], None, [], []
+    matrix = embed_matrix([c["text"] for _, c in chunks], embedder)
+    return [c["id"] for _, c in chunks], matrix, [c["metadata"] for _, c in chunks], [scene_id for scene_id, _ in chunks]
+
+
+def concat_parts(parts):
+    parts = [p for p in parts if p[0]]
+    if not parts:
+        return LocalVectorIndex()
+    return LocalVectorIndex(
+        [i for p in parts for i in p[0]],
+        np.vstack([p[1] for p in parts]),
+        [m for p in parts for m in p[2]],
+        [s for p in parts for s in p[3]]
+    )
+
+
+# --- Supabaseの全シーンからローカルインデックスを作る ---
+# メタデータは save_to_pinecone と同じものを使い、埋め込みはキャッシュ付きエンベッダーで済ませる
+def build_local_index(supabase, embedder, page_size=LOAD_PAGE_SIZE):
+    return concat_parts([embed_page(page, embedder) for page in iter_pages(supabase, SYNC_COLUMNS, page_size)])
+
+
+# --- 差分更新するローカルインデックス ---
+# シーンごとの version を覚えておき、変わったシーンと消えたシーンの行だけを入れ替える
+# 更新は初回も含めて別スレッドで行い（初回は全シーンの埋め込みになりうる）、終わるまでは前の索引で検索する
+class IncrementalLocalIndex:
+    def __init__(self, supabase, embedder, page_size=LOAD_PAGE_SIZE):
+        self.supabase = supabase
+        self.embedder = embedder
+        self.page_size = page_size
+        self.index = LocalVectorIndex()
+        self.versions = None
+        self.token = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def refresh(self):
+        with self._refresh_lock, metrics.timer("local_index.refresh"):
+            listed = {r["id"]: r["version"] for page in iter_pages(self.supabase, "id, version", self.page_size, timer="supabase.version_page") for r in page}
+            known = self.versions or {}
+            changed = [scene_id for scene_id, version in listed.items() if known.get(scene_id) != version]
+            changed_set = set(changed)
+            old = self.index
+            parts = [old.part([s in listed and s not in changed_set for s in old.scene_ids])]
+            versions = {scene_id: version for scene_id, version in listed.items() if scene_id not in changed_set}
+            for start in range(0, len(changed), self.page_size):
+                with metrics.timer("supabase.changed_page"):
+                    rows = self.supabase.table("scenario_plots").select(SYNC_COLUMNS).in_("id", changed[start:start + self.page_size]).execute().data
+                parts.append(embed_page(rows, self.embedder))
+                versions.update((r["id"], r["version"]) for r in rows)
+            self.index = concat_parts(parts)
+            self.versions = versions
+            metrics.count("local_index.reembedded_scenes", len(changed))
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            metrics.log_json("local_index.refresh_failed", error=str(e))
+            # 次の呼び出しでやり直す
+            with self._lock:
+                self.token = None
+
+    # token が変わっていれば更新を始める。初回の索引ができるまでは None を返す
+    def current(self, token):
+        with self._lock:
+            if token != self.token and not (self._thread and self._thread.is_alive()):
+                self.token = token
+                self._thread = threading.Thread(target=self._refresh_in_background, daemon=True)
+                self._thread.start()
+        return self.index if self.versions is not None else None
@@ -0,0 +1,95 @@
+from embedding import EMBEDDING_MODEL
+
+VECTOR_TARGET_KEY = "vector_target"
+
+
+class TargetChangedError(Exception):
+    pass
+
+
+# --- ベクトルの読み書き先 ---
+# app_config の1行（sql/003_vector_target.sql）にインデックス・名前空間・モデルをまとめて持つ
+# 1行の書き換えなので、読み手は切り替え前か後のどちらか一方だけを見る
+def default_target(index_name):
+    return {"index": index_name, "namespace": "", "model": EMBEDDING_MODEL}
+
+
+def load_active_target(supabase, index_name):
+    rows = supabase.table("app_config").select("value").eq("key", VECTOR_TARGET_KEY).limit(1).execute().data
+    return dict(default_target(index_name), **rows[0]["value"]) if rows else default_target(index_name)
+
+
+def save_active_target(supabase, target):
+    supabase.table("app_config").upsert({"key": VECTOR_TARGET_KEY, "value": target}, on_conflict="key").execute()
+
+
+# 長い同期・取り込みでは、バッチを書き込むたびに読み書き先を読み直す
+# 切り替わっていたら旧読み書き先への書き込みとフラグ解除をやめ、続きは新しい読み書き先での次の同期に任せる
+def target_guard(supabase, target, index_name):
+    def check():
+        latest = load_active_target(supabase, index_name)
+        if latest != target:
+            raise TargetChangedError(f"書き込み先が切り替わりました: {target_label(latest)}")
+    return check
+
+
+# --- 切り戻し用の起点 ---
+# 読み書き先を切り替えたとき、旧読み書き先に反映されていない変更の起点（変更履歴の seq）を残しておく
+# 切り戻すときは、そこから変更履歴を追いかけてから読み書き先を戻す
+def _left_key(target):
+    return f"{VECTOR_TARGET_KEY}.left:{target_label(target)}"
+
+
+def save_left_seq(supabase, target, seq):
+    supabase.table("app_config").upsert({"key": _left_key(target), "value": {"target": target, "seq": seq}}, on_conflict="key").execute()
+
+
+def load_left_seq(supabase, target):
+    rows = supabase.table("app_config").select("value").eq("key", _left_key(target)).limit(1).execute().data
+    return rows[0]["value"]["seq"] if rows else None
+
+
+# 読み書き先に戻ったら、その読み書き先の起点は要らなくなる
+def clear_left_seq(supabase, target):
+    supabase.table("app_config").delete().eq("key", _left_key(target)).execute()
+
+
+# 変更履歴の削除で残す位置を決めるのに使う
+def load_left_seqs(supabase):
+    rows = supabase.table("app_config").select("value").like("key", f"{VECTOR_TARGET_KEY}.left:%").execute().data
+    return [r["value"]["seq"] for r in rows]
+
+
+def target_label(target):
+    return f"{target['index']}/{target['namespace'] or '(default)'}（{target['model']}）"
+
+
+# --- 名前空間付きインデックス ---
+# Pinecone.Index と同じメソッドで、すべての呼び出しに namespace を付けて渡す
+class NamespacedIndex:
+    def __init__(self, index, namespace=""):
+        self.index = index
+        self.namespace = namespace
+
+    def upsert(self, vectors):
+        return self.index.upsert(vectors=vectors, namespace=self.namespace)
+
+    def update(self, id, values=None, set_metadata=None):
+        return self.index.update(id=id, values=values, set_metadata=set_metadata, namespace=self.namespace)
+
+    def delete(self, ids=None, delete_all=False):
+        if delete_all:
+            return self.index.delete(delete_all=True, namespace=self.namespace)
+        return self.index.delete(ids=ids, namespace=self.namespace)
+
+    def list(self, prefix="", **kwargs):
+        return self.index.list(prefix=prefix, namespace=self.namespace, **kwargs)
+
+    def fetch(self, ids):
+        return self.index.fetch(ids=ids, namespace=self.namespace)
+
+    def query(self, vector, top_k=10, filter=None, include_metadata=True):
+        return self.index.query(vector=vector, top_k=top_k, filter=filter, include_metadata=include_metadata, namespace=self.namespace)
+
+    def describe_index_stats(self):
+        return self.index.describe_index_stats()